@@ -1,43 +1,567 @@
+import hashlib
+import hmac
+import os
+import secrets
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
 import bcrypt
-from flask import Flask, jsonify, request
+import click
+from flask import Flask, Response, g, jsonify, request, stream_with_context
 from flask_bcrypt import Bcrypt
+from itsdangerous import BadSignature, SignatureExpired, URLSafeTimedSerializer
+from sqlalchemy import create_engine, select
+from sqlalchemy.orm import Query, Session
+from sqlalchemy.pool import StaticPool
+from werkzeug.test import EnvironBuilder
+
+from cache import TTLCache
+from compression import available_encodings, compress_response
+from config import Config
+from database import (engine_options, forget_tables, install_sqlite_pragmas,
+                      table_exists)
+from export import EXPORT_MIMETYPE, export_formats, export_transactions
+from ingest import IMPORTS, import_records, read_records
+from instrumentation import Instrumentation, RequestTimings, current_timings
+from metrics import PROMETHEUS_MIMETYPE, MetricsRegistry
+from migrations import upgrade_db
+from partitions import (PARTITIONED_VIEW, add_months, archive_partition,
+                        partition_months, partition_name,
+                        partition_transactions, partitioned_view,
+                        transaction_source)
+from passwords import PasswordPool, PasswordPoolBusy
+from queries import (QueryError, field_columns, lookup_ids, lookup_query,
+                     paginate, patient_fields, patient_filters,
+                     pharmacy_fields, pharmacy_filters, rollup_query,
+                     select_fields, transaction_columns, transaction_fields,
+                     transaction_filters, transaction_query,
+                     transaction_summary)
+from replicas import create_replica_set
+from response_cache import cache_key, create_response_cache, make_etag
+from rollups import ROLLUP_COLUMNS, rebuild_rollups, track_rollups
+from search import SEARCH_COLUMNS, rebuild_search_index, search_index_available
+from serializers import (NDJSON_MIMETYPE, fields_serializer, json_encoder,
+                         patient_to_dict, pharmacy_to_dict, stream_format,
+                         stream_rows, transaction_to_dict)
+from versions import data_versions, track_data_versions
+
+
+def ensureSecretKey(config, logger):
+    """
+    Function used to make sure tokens can be signed, with a random key of this process when SECRET_KEY isn't set.
+
+    A token signed with a random key is rejected by every other worker, so that is only right for a single process,
+    e.g. the tests or flask run, and is reported as an error.
+
+    Args:
+        config: app config.
+        logger: logger the missing key is reported to.
+    """
+
+    if config['SECRET_KEY']:
+        return
+    logger.error("SECRET_KEY is not set, tokens are signed with a random key "
+                 "and only accepted by the process that issued them. Set the "
+                 "same SECRET_KEY for every worker, as gunicorn_starter.sh "
+                 "does.")
+    config['SECRET_KEY'] = secrets.token_hex(32)
+
 
 app = Flask(__name__)
 bcrypt = Bcrypt(app)
 
 from models import (  # <-- this needs to be placed after app is created
-    Patient, Pharmacy, Transaction, User, db)
-
-db_name = 'backend_test.db'
+    Patient, Pharmacy, TransactionRollup, User, db)
 
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + db_name
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = True
+app.config.from_object(Config)
+ensureSecretKey(app.config, app.logger)
+app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', engine_options(app.config))
+install_sqlite_pragmas(app.config)
 
 db.init_app(app)
+track_data_versions(db.session)
+track_rollups(db.session)
+
+response_cache = create_response_cache(app.config)
+json_dumps = json_encoder(app.config['JSON_ENCODER'])
+compress_encodings = available_encodings(
+    app.config['COMPRESS_ENCODINGS'].split(","))
+
+# Metrics of this worker, served by /metrics.
+metrics = MetricsRegistry()
+password_pool = PasswordPool(bcrypt, app.config['PASSWORD_HASH_PROCESSES'],
+                             app.config['PASSWORD_HASH_QUEUE_SIZE'], metrics)
+instrumentation = Instrumentation(metrics)
+if app.config['INSTRUMENTATION']:
+    instrumentation.enable(app)
+
+# Read replicas serving the list endpoints, None reads from the primary.
+replicas = create_replica_set(app.config, metrics)
+
+# Threads running the sub-queries of /batch, shared by the requests of a
+# worker so they never hold more than BATCH_THREADS extra connections.
+batch_pool = ThreadPoolExecutor(
+    app.config['BATCH_THREADS']) if app.config['BATCH_THREADS'] > 1 else None
+
+# Recently verified credentials, keyed by username. Each gunicorn worker keeps
+# its own copy so entries only live for LOGIN_CACHE_TTL seconds.
+login_cache = TTLCache(app.config['LOGIN_CACHE_SIZE'],
+                       app.config['LOGIN_CACHE_TTL'])
+_login_cache_key = secrets.token_bytes(32)
+
+# Serialized patients, pharmacies and transactions read by id, keyed by
+# (table name, id) and stored with the data versions they were read at.
+identity_cache = TTLCache(app.config['IDENTITY_CACHE_SIZE'],
+                          app.config['IDENTITY_CACHE_TTL'])
+
+# Users allowed to register new users and import data.
+ADMIN_UUIDS = ("TESTER", "USER1")
+
+IMPORT_MIMETYPES = {"text/csv": "csv", NDJSON_MIMETYPE: "ndjson"}
+
+TRANSACTION_TABLES = ("patients", "pharmacies", "transactions")
+
+# Tables whose rows can be read by id, with the tables their rows are built
+# from and their serializer.
+LOOKUP_TABLES = {
+    "patients": (("patients", ), patient_to_dict),
+    "pharmacies": (("pharmacies", ), pharmacy_to_dict),
+    "transactions": (TRANSACTION_TABLES, transaction_to_dict),
+}
+
+# Headers stored with the cached responses.
+CACHED_HEADERS = ("Content-Type", "Content-Encoding", "Vary", "X-Next-Cursor")
 
+token_serializer = URLSafeTimedSerializer(app.config['SECRET_KEY'],
+                                          salt='auth-token')
 
+
+def credential_digest(password):
+    """
+    Function used to derive the value stored in the login cache for a password.
+
+    Args:
+        password: plain text password sent by the client.
+
+    Returns:
+        (str) keyed digest of the password, never the password itself.
+    """
+
+    return hmac.new(_login_cache_key, password.encode('utf-8'),
+                    hashlib.sha256).hexdigest()
+
+
+@instrumentation.timed("auth")
 def login(request):
     """
     Function used to handle login of users.
 
+    A valid bearer token in the Authorization header is accepted without touching the db. Otherwise the username
+    and password in the request body are checked, credentials verified recently are answered from login_cache,
+    skipping both the user lookup and the bcrypt check.
+
+    On success the authenticated user is stored in flask.g as user_uuid and username.
+
     Args:
-        request: request data with username and password for authentication.
+        request: request data with a bearer token or username and password for authentication.
 
     Returns:
         (bool) True if user credentials are valid else False.
         (str) Descriptive message of login result.
     """
 
-    if "username" not in request.json or "password" not in request.json:
+    result = quickLogin(request)
+    if result is not None:
+        return result
+
+    credentials = request.get_json(silent=True)
+    user = User.query.filter_by(username=credentials["username"]).first()
+    valid = user is not None and password_pool.check(user.password,
+                                                     credentials["password"])
+    return passwordLogin(user, credentials, valid)
+
+
+def quickLogin(request):
+    """
+    Function used to try the logins that need neither the db nor bcrypt: bearer tokens and login_cache.
+
+    Args:
+        request: request data with a bearer token or username and password for authentication.
+
+    Returns:
+        (tuple) result of login, or None if the password must be checked against the user in the db.
+    """
+
+    authorization = request.headers.get("Authorization", "")
+    if authorization.startswith("Bearer "):
+        try:
+            payload = token_serializer.loads(
+                authorization[len("Bearer "):],
+                max_age=app.config['TOKEN_MAX_AGE'])
+        except SignatureExpired:
+            return False, "token expired."
+        except BadSignature:
+            return False, "invalid token."
+        g.user_uuid, g.username = payload["id"], payload["username"]
+        return True, "login successful."
+
+    credentials = request.get_json(silent=True) or {}
+    if "username" not in credentials or "password" not in credentials:
         return False, "missing keys in POST request body"
 
-    user = User.query.filter_by(username=request.json["username"]).first()
-    if user:
-        if bcrypt.check_password_hash(user.password, request.json["password"]):
-            return True, "login successful."
-        else:
-            return False, "wrong password."
-    return False, "username doesn't exist."
+    username = credentials["username"]
+    cached = login_cache.get(username)
+    if cached is not None and hmac.compare_digest(
+            cached[0], credential_digest(credentials["password"])):
+        g.user_uuid, g.username = cached[1], username
+        return True, "login successful."
+    return None
+
+
+def passwordLogin(user, credentials, valid):
+    """
+    Function used to finish a login once the password has been checked.
+
+    Args:
+        user: user (or row with its uuid) with the username of credentials, None if there is none.
+        credentials: username and password sent by the client.
+        valid: True if the password matched the user's hash.
+
+    Returns:
+        (tuple) result of login.
+    """
+
+    if user is None:
+        return False, "username doesn't exist."
+    if not valid:
+        return False, "wrong password."
+
+    username = credentials["username"]
+    login_cache.set(username,
+                    (credential_digest(credentials["password"]), user.uuid))
+    g.user_uuid, g.username = user.uuid, username
+    return True, "login successful."
+
+
+@app.route('/login', methods=['POST'])
+def issueToken():
+    """
+    View for exchanging user credentials for a signed bearer token.
+
+    The token is sent back in the header "Authorization: Bearer <token>" and is accepted by every endpoint in
+    place of the username and password until it expires.
+
+    Args:
+        None
+
+    Returns:
+        (dict) Either 'error' with a descriptive message or 'token' and 'expires_in' with its lifetime in seconds.
+    """
+
+    return tokenResult(*login(request))
+
+
+def tokenResult(logged_in, msg):
+    if logged_in:
+        token = token_serializer.dumps({
+            "id": g.user_uuid,
+            "username": g.username
+        })
+        return {"token": token, "expires_in": app.config['TOKEN_MAX_AGE']}
+
+    return {"error": msg}
+
+
+@app.cli.command("upgrade-db")
+def upgradeDbCommand():
+    """
+    Create the missing tables and indexes in the configured database.
+    """
+
+    for name in upgrade_db(db.engine):
+        click.echo(f"created index {name}")
+    click.echo("database is up to date.")
+
+
+@app.cli.command("rebuild-search-index")
+def rebuildSearchIndexCommand():
+    """
+    Refill the full-text search indexes from the patients and pharmacies tables.
+    """
+
+    with db.engine.begin() as conn:
+        for table_name in SEARCH_COLUMNS:
+            if search_index_available(table_name):
+                rebuild_search_index(conn, table_name)
+                click.echo(f"rebuilt {table_name}_fts")
+
+
+@app.cli.command("partition-transactions")
+@click.option("--before",
+              type=click.DateTime(["%Y-%m"]),
+              default=None,
+              help="Oldest month kept in the transactions table, "
+              "TRANSACTION_HOT_MONTHS months back including the current one "
+              "by default.")
+def partitionTransactionsCommand(before):
+    """
+    Move the transactions of older months into monthly partitions.
+    """
+
+    if not table_exists(db.engine, PARTITIONED_VIEW):
+        raise click.ClickException("run flask upgrade-db first.")
+    if before is None:
+        today = datetime.now()
+        before = add_months(today, 1 - app.config['TRANSACTION_HOT_MONTHS'])
+    for month, count in partition_transactions(db.engine, before):
+        click.echo(f"moved {count} transactions to {partition_name(month)}")
+    click.echo("transactions are partitioned.")
+
+
+@app.cli.command("archive-transactions")
+@click.argument("month", type=click.DateTime(["%Y-%m"]))
+@click.argument("path", type=click.Path(dir_okay=False))
+def archiveTransactionsCommand(month, path):
+    """
+    Move the partition of a month into a new SQLite file, its transactions are no longer served.
+    """
+
+    with db.engine.connect() as conn:
+        if month not in partition_months(conn):
+            raise click.ClickException(
+                f"there is no partition for {month:%Y-%m}.")
+    if os.path.exists(path):
+        raise click.ClickException(f"{path} already exists.")
+    archive = create_engine("sqlite:///" + path)
+    try:
+        count = archive_partition(db.engine, month, archive,
+                                  app.config['STREAM_BATCH_SIZE'])
+    finally:
+        archive.dispose()
+    forget_tables()
+    click.echo(f"archived {count} transactions of {month:%Y-%m} to {path}")
+
+
+@app.cli.command("rebuild-rollups")
+def rebuildRollupsCommand():
+    """
+    Recompute the daily and monthly transaction totals from the transactions.
+    """
+
+    if not table_exists(db.engine, TransactionRollup.__tablename__):
+        raise click.ClickException("run flask upgrade-db first.")
+    statement = select(*[partitioned_view.c[name] for name in ROLLUP_COLUMNS])
+    with db.engine.begin() as conn:
+        count = rebuild_rollups(conn, statement,
+                                app.config['STREAM_BATCH_SIZE'])
+    click.echo(f"rebuilt {count} totals.")
+
+
+@app.cli.command("import-data")
+@click.argument("table_name", type=click.Choice(list(IMPORTS)))
+@click.argument("file", type=click.File("rb"))
+@click.option("--format",
+              "fmt",
+              type=click.Choice(["csv", "ndjson"]),
+              help="Defaults to csv for .csv files, ndjson otherwise.")
+@click.option("--chunk-size",
+              type=int,
+              default=None,
+              help="Records per transaction, IMPORT_CHUNK_SIZE by default.")
+def importDataCommand(table_name, file, fmt, chunk_size):
+    """
+    Import the records of a csv or ndjson FILE into TABLE_NAME.
+    """
+
+    fmt = fmt or ("csv" if file.name.endswith(".csv") else "ndjson")
+
+    def on_chunk(chunk):
+        click.echo(f"chunk {chunk['chunk']}: {chunk['inserted']} inserted, "
+                   f"{chunk['rejected']} rejected")
+        for error in chunk["errors"]:
+            click.echo(f"  line {error['line']}: {error['error']}")
+
+    report = import_records(table_name, read_records(file, fmt), chunk_size
+                            or app.config['IMPORT_CHUNK_SIZE'], on_chunk)
+    click.echo(
+        f"{report['inserted']} inserted, {report['rejected']} rejected.")
+
+
+@app.errorhandler(QueryError)
+def queryError(error):
+    return {"error": str(error)}
+
+
+@app.errorhandler(PasswordPoolBusy)
+def passwordPoolBusy(error):
+    # the pool checking passwords is full, see passwords.PasswordPool
+    body = {"error": "too many logins in progress, try again later"}
+    return body, 503, {"Retry-After": "1"}
+
+
+def cachedResponse(tables, build):
+    """
+    Function used to answer a request to a list endpoint from the response cache when possible.
+
+    Responses are cached by endpoint, query string parameters in any order, Content-Encoding and the data versions
+    of the tables the endpoint reads, so any write to those tables makes the old entries unreachable. Bodies are
+    cached already compressed, so each one is compressed once. Every buffered response gets an ETag, and a request
+    whose If-None-Match has it is answered with 304 and no body. Streamed responses are never cached.
+
+    Args:
+        tables: names of the tables the response is built from.
+        build: function building the response when it isn't cached.
+
+    Returns:
+        Flask response.
+    """
+
+    if stream_format(request) is not None:
+        return build()
+
+    encoding = responseEncoding()
+    versions = data_versions(
+        tables, readSession()) if response_cache is not None else None
+    key, entry = cacheLookup(versions, encoding)
+    if entry is None:
+        return cacheStore(key, build(), encoding)
+    return cacheHit(entry)
+
+
+def readSession():
+    """
+    Function used to get the session the list endpoints read with.
+
+    The replica is picked once per request, see replicas.ReplicaSet, so the rows and the data versions keying the
+    response cache come from the same database. Writes always use db.session, bound to the primary.
+
+    Returns:
+        Session bound to a fresh read replica, or db.session when there is none.
+    """
+
+    if replicas is None:
+        return db.session
+    if "read_session" not in g:
+        engine = replicas.choose(db.engine)
+        g.read_session = Session(bind=engine) if engine is not None else None
+    return g.read_session or db.session
+
+
+@app.teardown_appcontext
+def closeReadSession(error):
+    session = g.pop("read_session", None)
+    if session is not None:
+        session.close()
+
+
+def cacheLookup(versions, encoding):
+    """
+    Function used to find the cached response of the current request.
+
+    Args:
+        versions: data versions of the tables the endpoint reads, None if they aren't tracked.
+        encoding: Content-Encoding of the response.
+
+    Returns:
+        (str) cache key, None if the response can't be cached.
+        (tuple) cached (etag, body, headers), None if there is none.
+    """
+
+    if versions is None:
+        return None, None
+    key = cache_key(request.path, request.args, versions, encoding)
+    return key, response_cache.get(key)
+
+
+@instrumentation.timed("cache")
+def cacheStore(key, response, encoding):
+    """
+    Function used to compress a response that wasn't cached, store it under key and answer the request with it.
+    """
+
+    etag = make_etag(response.get_data())
+    response.set_etag(etag)
+    compress_response(response, encoding, app.config['COMPRESS_MIN_SIZE'])
+    body = response.get_data()
+    headers = {
+        name: response.headers[name]
+        for name in CACHED_HEADERS if name in response.headers
+    }
+    if key is not None and len(
+            body) <= app.config['RESPONSE_CACHE_MAX_ENTRY_BYTES']:
+        response_cache.set(key, etag, body, headers)
+    response.headers["X-Cache"] = "MISS"
+    return conditionalResponse(response, etag, headers)
+
+
+def cacheHit(entry):
+    """
+    Function used to answer the request with a response found by cacheLookup.
+    """
+
+    etag, body, headers = entry
+    response = Response(body, headers=headers)
+    response.set_etag(etag, weak="Content-Encoding" in headers)
+    response.headers["X-Cache"] = "HIT"
+    return conditionalResponse(response, etag, headers)
+
+
+def conditionalResponse(response, etag, headers):
+    # 304 without a body if the client already has this version
+    if request.if_none_match.contains_weak(etag):
+        not_modified = Response(status=304, headers=headers)
+        del not_modified.headers["Content-Encoding"]
+        not_modified.set_etag(etag, weak="Content-Encoding" in headers)
+        return not_modified
+    return response
+
+
+def responseEncoding():
+    """
+    Function used to choose the Content-Encoding of the response from the Accept-Encoding header of the request.
+
+    Returns:
+        (str) one of COMPRESS_ENCODINGS, the first one in case of a tie, or None to send the body as it is.
+    """
+
+    return request.accept_encodings.best_match(compress_encodings)
+
+
+@app.after_request
+@instrumentation.timed("compress")
+def compressResponse(response):
+    # responses built by cachedResponse are already compressed
+    return compress_response(response, responseEncoding(),
+                             app.config['COMPRESS_MIN_SIZE'])
+
+
+@instrumentation.timed("serialize")
+def listResponse(rows, serialize, next_cursor, fmt):
+    """
+    Function used to build the response of the list endpoints.
+
+    Args:
+        rows: rows to send.
+        serialize: function turning a row tuple into a dict.
+        next_cursor: cursor of the next page, sent in the X-Next-Cursor header if not None.
+        fmt: None for a regular json response or the streaming format returned by stream_format.
+
+    Returns:
+        Flask response with the serialized rows.
+    """
+
+    if fmt is None:
+        response = Response(json_dumps([serialize(row) for row in rows]),
+                            mimetype="application/json")
+    else:
+        body = stream_rows(rows, serialize, json_dumps, fmt,
+                           app.config['STREAM_BATCH_SIZE'])
+        mimetype = NDJSON_MIMETYPE if fmt == "ndjson" else "application/json"
+        response = Response(stream_with_context(body), mimetype=mimetype)
+
+    if next_cursor is not None:
+        response.headers["X-Next-Cursor"] = next_cursor
+    return response
 
 
 @app.route('/register', methods=['POST'])
@@ -63,14 +587,14 @@ def register():
         if len(request.json["new_password"]) < 8:
             return {"error": "password must have at least 8 characters"}
 
-        hashed_pass = bcrypt.generate_password_hash(
-            request.json["new_password"])
+        hashed_pass = password_pool.generate(request.json["new_password"])
         user_id = "USER" + str(User.query.count() + 1)
         user = User(uuid=user_id,
                     username=request.json["new_username"],
                     password=hashed_pass)
         db.session.add(user)
         db.session.commit()
+        login_cache.invalidate(user.username)
         return {"success": "registration successful."}
 
     logged_in, msg = login(request)
@@ -84,23 +608,21 @@ def register():
         if len(request.json["new_password"]) < 8:
             return {"error": "password must have at least 8 characters"}
 
-        req_user = User.query.filter_by(
-            username=request.json["username"]).first()
-        if req_user.uuid in ("TESTER", "USER1"):
+        if g.user_uuid in ADMIN_UUIDS:
             existing_username = User.query.filter_by(
                 username=request.json["new_username"]).first()
 
             if existing_username:
                 return {"error": "username already exists."}
 
-            hashed_pass = bcrypt.generate_password_hash(
-                request.json["new_password"])
+            hashed_pass = password_pool.generate(request.json["new_password"])
             user_id = "USER" + str(User.query.count() + 1)
             user = User(uuid=user_id,
                         username=request.json["new_username"],
                         password=hashed_pass)
             db.session.add(user)
             db.session.commit()
+            login_cache.invalidate(user.username)
             return {"success": "registration successful."}
 
         return {"error": "current user is not allowed to register new users"}
@@ -108,6 +630,46 @@ def register():
     return {"error": msg}
 
 
+@app.route('/import/<table_name>', methods=['POST'])
+def importData(table_name):
+    """
+    View for importing patients, pharmacies or transactions in bulk.
+
+    The request body is the file itself, as csv with a header line (Content-Type text/csv) or one json object per
+    line (Content-Type application/x-ndjson), so credentials must be sent as a bearer token. Records use the same
+    fields as the list endpoints, e.g. id, patient_id, pharmacy_id, amount and timestamp for transactions. They are
+    read as the body arrives and inserted IMPORT_CHUNK_SIZE at a time, each chunk in its own transaction.
+
+    Args:
+        table_name: one of 'patients', 'pharmacies' or 'transactions'.
+
+    Returns:
+        (dict) Either 'error' with a descriptive message or the number of rows inserted and rejected, in total and
+        per chunk, with the reasons for the first rejections of each chunk.
+    """
+
+    logged_in, msg = login(request)
+    if logged_in:
+        if g.user_uuid not in ADMIN_UUIDS:
+            return {"error": "current user is not allowed to import data"}
+
+        if table_name not in IMPORTS:
+            return {"error": f"can only import {', '.join(IMPORTS)}"}
+
+        fmt = request.args.get("format",
+                               IMPORT_MIMETYPES.get(request.mimetype))
+        if fmt not in ("csv", "ndjson"):
+            return {
+                "error":
+                "body must be csv (text/csv) or ndjson (application/x-ndjson)"
+            }
+
+        return import_records(table_name, read_records(request.stream, fmt),
+                              app.config['IMPORT_CHUNK_SIZE'])
+
+    return {"error": msg}
+
+
 @app.route('/', methods=['POST'])
 def index():
     """
@@ -123,11 +685,213 @@ def index():
 
     logged_in, msg = login(request)
     if logged_in:
-        return {"endpoints": ["/patients", "/pharmacies", "/transactions"]}
+        return {
+            "endpoints": [
+                "/patients", "/patients/<id>", "/pharmacies",
+                "/pharmacies/<id>", "/transactions", "/transactions/<id>",
+                "/transactions/summary", "/transactions/rollups", "/batch"
+            ]
+        }
 
     return {"error": msg}
 
 
+@app.route('/metrics', methods=['GET'])
+def getMetrics():
+    """
+    View for the metrics of the worker serving the request, in the Prometheus text format.
+
+    Args:
+        None
+
+    Returns:
+        The password pool queue depth, rejections and bcrypt durations, and with INSTRUMENTATION on the latency
+        and SQL statements of each route.
+    """
+
+    return Response(metrics.render(), mimetype=PROMETHEUS_MIMETYPE)
+
+
+def rowSerializer(fields, serialize_all):
+    # serialize_all is a faster serializer for rows with every field
+    if "fields" in request.args:
+        return fields_serializer(fields)
+    return serialize_all
+
+
+def patientsQuery():
+    """
+    Function used to build the query of /patients from the request parameters.
+
+    Returns:
+        Query, without a session, whose rows have the selected fields followed by the sort keys.
+        (tuple) columns to sort by.
+        Function turning a row into a dict.
+    """
+
+    fields = select_fields(patient_fields(), request.args)
+    keys = (Patient.first_name, Patient.uuid)
+    query = Query([*field_columns(fields),
+                   *keys]).filter(*patient_filters(request.args))
+    return query, keys, rowSerializer(fields, patient_to_dict)
+
+
+def pharmaciesQuery():
+    """
+    Function used to build the query of /pharmacies from the request parameters, see patientsQuery.
+    """
+
+    fields = select_fields(pharmacy_fields(), request.args)
+    keys = (Pharmacy.name, Pharmacy.uuid)
+    query = Query([*field_columns(fields),
+                   *keys]).filter(*pharmacy_filters(request.args))
+    return query, keys, rowSerializer(fields, pharmacy_to_dict)
+
+
+def transactionsQuery():
+    """
+    Function used to build the query of /transactions from the request parameters, see patientsQuery.
+    """
+
+    fields = select_fields(transaction_fields(), request.args)
+    query, keys = transaction_query(fields, request.args)
+    return query, keys, rowSerializer(fields, transaction_to_dict)
+
+
+def pagedResponse(query, keys, serialize):
+    """
+    Function used to run the query of a list endpoint and send the requested page of rows.
+    """
+
+    fmt = stream_format(request)
+    rows, next_cursor = fetchPage(query, keys, fmt)
+    return listResponse(rows, serialize, next_cursor, fmt)
+
+
+@instrumentation.timed("query")
+def fetchPage(query, keys, fmt):
+    # streamed rows are read by listResponse, only the page query is timed
+    batch_size = app.config['STREAM_BATCH_SIZE'] if fmt else None
+    return paginate(query.with_session(readSession()), keys,
+                    lambda row: row[-len(keys):], request.args, batch_size)
+
+
+@instrumentation.timed("query")
+def fetchAll(query):
+    return query.with_session(readSession()).all()
+
+
+def patientsResponse():
+    if "ids" in request.args:
+        return lookupResponse("patients")
+    return pagedResponse(*patientsQuery())
+
+
+def pharmaciesResponse():
+    if "ids" in request.args:
+        return lookupResponse("pharmacies")
+    return pagedResponse(*pharmaciesQuery())
+
+
+def transactionsResponse():
+    if "ids" in request.args:
+        return lookupResponse("transactions")
+    return pagedResponse(*transactionsQuery())
+
+
+def lookupRows(table_name, ids):
+    """
+    Function used to read patients, pharmacies or transactions by primary key, through identity_cache.
+
+    A cached row is served only if the data versions of the tables it is built from didn't change since it was
+    read, so any write to them makes it unreachable. The rows that aren't cached are read with a single query.
+    Without data versions, until flask upgrade-db, nothing is cached.
+
+    Args:
+        table_name: one of LOOKUP_TABLES.
+        ids: ids of the rows.
+
+    Returns:
+        (list) serialized rows in the order of ids, the ones that don't exist are left out.
+    """
+
+    tables, serialize = LOOKUP_TABLES[table_name]
+    versions = data_versions(tables, readSession())
+    found, missing = {}, []
+    for uuid in ids:
+        entry = identity_cache.get(
+            (table_name, uuid)) if versions is not None else None
+        if entry is not None and entry[0] == versions:
+            found[uuid] = entry[1]
+        else:
+            missing.append(uuid)
+
+    if missing:
+        for row in fetchAll(lookup_query(table_name, missing)):
+            found[row[0]] = serialize(row)
+            if versions is not None:
+                identity_cache.set((table_name, row[0]),
+                                   (versions, found[row[0]]))
+    return [found[uuid] for uuid in ids if uuid in found]
+
+
+def lookupResponse(table_name):
+    # ids parameter of the list endpoints, see queries.lookup_ids
+    rows = lookupRows(table_name, lookup_ids(request.args))
+    return Response(json_dumps(rows), mimetype="application/json")
+
+
+def pointResponse(table_name, uuid, label):
+    """
+    Function used to answer the lookup of a single row by id, see lookupRows.
+    """
+
+    logged_in, msg = login(request)
+    if not logged_in:
+        return {"error": msg}
+
+    rows = lookupRows(table_name, [uuid])
+    if not rows:
+        return {"error": f"{label} not found"}, 404
+    return Response(json_dumps(rows[0]), mimetype="application/json")
+
+
+def exportResponse():
+    fmt = request.args["format"]
+    if fmt not in export_formats():
+        raise QueryError(
+            f"format must be one of {', '.join(export_formats())}")
+
+    transactions = readSession().query(
+        *transaction_columns(format_dates=fmt != "arrow")).select_from(
+            transaction_source(db.engine)).join(Patient).join(Pharmacy).filter(
+                *transaction_filters(request.args)).yield_per(
+                    app.config['STREAM_BATCH_SIZE'])
+    body = export_transactions(transactions, fmt,
+                               app.config['STREAM_BATCH_SIZE'])
+    response = Response(stream_with_context(body), mimetype=EXPORT_MIMETYPE)
+    response.headers["Content-Disposition"] = (
+        f"attachment; filename=transactions-{fmt}.zip")
+    return response
+
+
+def rollupsResponse():
+    if not table_exists(db.engine, TransactionRollup.__tablename__):
+        raise QueryError("rollups are not available yet")
+    query, labels = rollup_query(request.args)
+    return summaryRows(fetchAll(query), labels)
+
+
+def summaryResponse():
+    query, labels = transaction_summary(request.args)
+    return summaryRows(fetchAll(query), labels)
+
+
+@instrumentation.timed("serialize")
+def summaryRows(rows, labels):
+    return jsonify([dict(zip(labels, row)) for row in rows])
+
+
 @app.route('/patients', methods=['POST'])
 def getPatients():
     """
@@ -142,38 +906,26 @@ def getPatients():
 
     logged_in, msg = login(request)
     if logged_in:
-        filters = []
-        if "first_name" in request.args:
-            arg = request.args["first_name"]
-            filters.append(Patient.first_name.like(f'%{arg}%'))
-        if "last_name" in request.args:
-            arg = request.args["last_name"]
-            filters.append(Patient.last_name.like(f'%{arg}%'))
-        if "date_of_birth" in request.args:
-            arg = request.args["date_of_birth"]
-            filters.append(Patient.date_of_birth.like(f'%{arg}%'))
-
-        patients = Patient.query.filter(*filters).order_by(
-            Patient.first_name).all()
-
-        obj = []
-        for patient in patients:
-            obj.append({
-                "id":
-                patient.uuid,
-                "first_name":
-                patient.first_name,
-                "last_name":
-                patient.last_name,
-                "date_of_birth":
-                patient.date_of_birth.strftime('%m/%d/%Y')
-            })
-
-        return jsonify(obj)
+        return cachedResponse(("patients", ), patientsResponse)
 
     return {"error": msg}
 
 
+@app.route('/patients/<uuid>', methods=['POST'])
+def getPatient(uuid):
+    """
+    View for returning a patient by id.
+
+    Args:
+        uuid: id of the patient.
+
+    Returns:
+        If failed returns the error message, otherwise returns a json with the patient data.
+    """
+
+    return pointResponse("patients", uuid, "patient")
+
+
 @app.route('/pharmacies', methods=['POST'])
 def getPharmacies():
     """
@@ -188,35 +940,34 @@ def getPharmacies():
 
     logged_in, msg = login(request)
     if logged_in:
-        filters = []
-        if "name" in request.args:
-            arg = request.args["name"]
-            filters.append(Pharmacy.name.like(f'%{arg}%'))
-        if "city" in request.args:
-            arg = request.args["city"]
-            filters.append(Pharmacy.city.like(f'%{arg}%'))
-
-        pharmacies = Pharmacy.query.filter(*filters).order_by(
-            Pharmacy.name).all()
-
-        obj = []
-        for pharmacy in pharmacies:
-            obj.append({
-                "id": pharmacy.uuid,
-                "name": pharmacy.name,
-                "city": pharmacy.city,
-            })
-
-        return jsonify(obj)
+        return cachedResponse(("pharmacies", ), pharmaciesResponse)
 
     return {"error": msg}
 
 
+@app.route('/pharmacies/<uuid>', methods=['POST'])
+def getPharmacy(uuid):
+    """
+    View for returning a pharmacy by id.
+
+    Args:
+        uuid: id of the pharmacy.
+
+    Returns:
+        If failed returns the error message, otherwise returns a json with the pharmacy data.
+    """
+
+    return pointResponse("pharmacies", uuid, "pharmacy")
+
+
 @app.route('/transactions', methods=['POST'])
 def getTransactions():
     """
     View for returning information about the transactions.
 
+    The parameter 'format' exports the transactions instead, as a zip file with normalized tables in which each
+    patient and pharmacy is written once: 'csv', or 'arrow' for Arrow IPC streams when pyarrow is installed.
+
     Args:
         None
 
@@ -226,58 +977,210 @@ def getTransactions():
 
     logged_in, msg = login(request)
     if logged_in:
-        filters = []
-        if "patient_first_name" in request.args:
-            arg = request.args["patient_first_name"]
-            filters.append(Patient.first_name.like(f'%{arg}%'))
-        if "patient_last_name" in request.args:
-            arg = request.args["patient_last_name"]
-            filters.append(Patient.last_name.like(f'%{arg}%'))
-        if "patient_date_of_birth" in request.args:
-            arg = request.args["patient_date_of_birth"]
-            filters.append(Patient.date_of_birth.like(f'%{arg}%'))
-        if "pharmacy_name" in request.args:
-            arg = request.args["pharmacy_name"]
-            filters.append(Pharmacy.name.like(f'%{arg}%'))
-        if "pharmacy_city" in request.args:
-            arg = request.args["pharmacy_city"]
-            filters.append(Pharmacy.city.like(f'%{arg}%'))
-        if "amount" in request.args:
-            arg = request.args["amount"]
-            filters.append(Transaction.amount == str(arg))
-        if "timestamp" in request.args:
-            arg = request.args["timestamp"]
-            filters.append(Transaction.timestamp.like(f'%{arg}%'))
-
-        transactions = Transaction.query.join(Patient).join(Pharmacy).filter(
-            *filters).order_by(Patient.first_name).all()
-
-        obj = []
-        for transaction in transactions:
-            obj.append({
-                "patient": {
-                    "id":
-                    transaction.patient.uuid,
-                    "first_name":
-                    transaction.patient.first_name,
-                    "last_name":
-                    transaction.patient.last_name,
-                    "date_of_birth":
-                    transaction.patient.date_of_birth.strftime('%m/%d/%Y'),
-                },
-                "pharmacy": {
-                    "id": transaction.pharmacy.uuid,
-                    "name": transaction.pharmacy.name,
-                    "city": transaction.pharmacy.city,
-                },
-                "id":
-                transaction.uuid,
-                "amount":
-                transaction.amount,
-                "timestamp":
-                transaction.timestamp.strftime('%m/%d/%Y %H:%M:%S'),
-            })
-
-        return jsonify(obj)
+        if "format" in request.args:
+            return exportResponse()
+        return cachedResponse(TRANSACTION_TABLES, transactionsResponse)
 
     return {"error": msg}
+
+
+@app.route('/transactions/<uuid>', methods=['POST'])
+def getTransaction(uuid):
+    """
+    View for returning a transaction by id, with its patient and pharmacy.
+
+    Args:
+        uuid: id of the transaction.
+
+    Returns:
+        If failed returns the error message, otherwise returns a json with the transaction data.
+    """
+
+    return pointResponse("transactions", uuid, "transaction")
+
+
+@app.route('/transactions/summary', methods=['POST'])
+def getTransactionsSummary():
+    """
+    View for returning the count, sum, average, minimum and maximum of the transaction amounts.
+
+    Accepts the same filters as /transactions, the parameter 'group_by' splits the result by pharmacy, city,
+    patient, day or month. Everything is computed by the database, only the aggregates are sent back.
+
+    Args:
+        None
+
+    Returns:
+        If failed returns the error message, otherwise returns a json with one object per group.
+    """
+
+    logged_in, msg = login(request)
+    if logged_in:
+        return cachedResponse(TRANSACTION_TABLES, summaryResponse)
+
+    return {"error": msg}
+
+
+@app.route('/transactions/rollups', methods=['POST'])
+def getTransactionsRollups():
+    """
+    View for returning the daily or monthly count and sum of the transaction amounts of each pharmacy or patient.
+
+    Totals are read from a table updated on every write of transactions, so the cost depends on the number of days
+    or months returned, not on the number of transactions. The parameters are described in queries.rollup_query.
+
+    Args:
+        None
+
+    Returns:
+        If failed returns the error message, otherwise returns a json with one object per day or month and pharmacy
+        or patient.
+    """
+
+    logged_in, msg = login(request)
+    if logged_in:
+        return cachedResponse(("transactions", ), rollupsResponse)
+
+    return {"error": msg}
+
+
+# Endpoints /batch can query, with the tables they read and the function
+# building their response.
+BATCH_ENDPOINTS = {
+    "/patients": (("patients", ), patientsResponse),
+    "/pharmacies": (("pharmacies", ), pharmaciesResponse),
+    "/transactions": (TRANSACTION_TABLES, transactionsResponse),
+    "/transactions/summary": (TRANSACTION_TABLES, summaryResponse),
+    "/transactions/rollups": (("transactions", ), rollupsResponse),
+}
+
+
+def batchItems(body):
+    """
+    Function used to read the sub-queries of a /batch request.
+
+    Args:
+        body: json body of the request.
+
+    Returns:
+        (list) id, path and query string parameters of each sub-query.
+    """
+
+    items = body.get("requests") if isinstance(body, dict) else None
+    if not isinstance(items, list) or not items:
+        raise QueryError("the body must have a non empty 'requests' list")
+    if len(items) > app.config['BATCH_MAX_REQUESTS']:
+        raise QueryError(f"a batch can't have more than "
+                         f"{app.config['BATCH_MAX_REQUESTS']} requests")
+
+    parsed, ids = [], set()
+    for item in items:
+        if not isinstance(item, dict) or not isinstance(item.get("id"), str):
+            raise QueryError("each request must be an object with an 'id'")
+        if item["id"] in ids:
+            raise QueryError(f"duplicated id {item['id']!r}")
+        ids.add(item["id"])
+        if item.get("path") not in BATCH_ENDPOINTS:
+            raise QueryError(
+                f"path must be one of {', '.join(BATCH_ENDPOINTS)}")
+        params = item.get("params", {})
+        if not isinstance(params, dict) or not all(
+                isinstance(value, (str, int, float))
+                for value in params.values()):
+            raise QueryError("params must be an object of strings or numbers")
+        if "stream" in params or "format" in params:
+            raise QueryError(
+                "streamed and exported responses can't be batched")
+        parsed.append((item["id"], item["path"],
+                       {name: str(value)
+                        for name, value in params.items()}))
+    return parsed
+
+
+def batchResult(path, params, timings=None):
+    """
+    Function used to run a sub-query of /batch as a request to path with the query string params would be, response
+    cache included, but without checking credentials again.
+
+    An error of the sub-query is only sent back for it, the others still run.
+
+    Args:
+        path: one of BATCH_ENDPOINTS.
+        params: query string parameters.
+        timings: instrumentation.RequestTimings the sub-query is timed in when it runs in another thread.
+
+    Returns:
+        (bytes) json object with the body of the response in 'data' and the cursor of the next page in
+        'next_cursor', or with the error message in 'error'.
+    """
+
+    tables, build = BATCH_ENDPOINTS[path]
+    environ = EnvironBuilder(path=path, method="POST",
+                             query_string=params).get_environ()
+    # in the thread of the request it shares its app context, so its session
+    with app.request_context(environ):
+        if timings is not None:
+            g.request_timings = timings
+        try:
+            response = cachedResponse(tables, build)
+        except QueryError as error:
+            return json_dumps({"error": str(error)})
+        except Exception:
+            app.logger.exception(f"Exception on batched {path}")
+            for session in (db.session, g.get("read_session")):
+                if session is not None:
+                    session.rollback()
+            return json_dumps({"error": "the request failed"})
+        next_cursor = json_dumps(response.headers.get("X-Next-Cursor"))
+        return (b'{"data":' + response.get_data().strip() +
+                b',"next_cursor":' + next_cursor + b'}')
+
+
+def batchResults(items):
+    if batch_pool is None or len(items) == 1 or isinstance(
+            db.engine.pool, StaticPool):
+        # one after the other, on the connection of the request
+        return [batchResult(path, params) for _, path, params in items]
+
+    # the threads have their own flask.g, their timings are added to the
+    # request's once they are done
+    parent = current_timings() if instrumentation.enabled else None
+    timings = [RequestTimings() if parent is not None else None for _ in items]
+    results = list(
+        batch_pool.map(lambda item, timing: batchResult(*item[1:], timing),
+                       items, timings))
+    for timing in timings:
+        if timing is not None:
+            parent.merge(timing)
+    return results
+
+
+@app.route('/batch', methods=['POST'])
+def batch():
+    """
+    View for running several queries of the read endpoints with a single login.
+
+    The body has the credentials, unless a token is sent, and a 'requests' list of objects with an 'id', the 'path'
+    of /patients, /pharmacies, /transactions, /transactions/summary or /transactions/rollups and the query string
+    'params' of the request. Streamed responses and exports can't be batched. Credentials are checked once, then the
+    sub-queries run in parallel in BATCH_THREADS threads, or one after the other on the connection of the request
+    when the database is a single in-memory connection.
+
+    Args:
+        None
+
+    Returns:
+        If failed returns the error message, otherwise returns a json object with the result of each sub-query keyed
+        by its id: {"data": body, "next_cursor": cursor or null} or {"error": message}.
+    """
+
+    logged_in, msg = login(request)
+    if not logged_in:
+        return {"error": msg}
+
+    items = batchItems(request.get_json(silent=True))
+    results = batchResults(items)
+    body = b",".join(
+        json_dumps(item_id) + b":" + result
+        for (item_id, _, _), result in zip(items, results))
+    return Response(b"{" + body + b"}", mimetype="application/json")
@@ -0,0 +1,332 @@
+import asyncio
+import contextvars
+import functools
+import sys
+from io import BytesIO
+from urllib.parse import parse_qs
+
+from flask import Response, request
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import create_async_engine
+from uvicorn.middleware.wsgi import WSGIMiddleware
+
+from app import (TRANSACTION_TABLES, app, cacheHit, cacheLookup, cacheStore,
+                 instrumentation, json_dumps, listResponse, password_pool,
+                 passwordLogin, patientsQuery, pharmaciesQuery, quickLogin,
+                 response_cache, responseEncoding, summaryRows, tokenResult,
+                 transactionsQuery)
+from database import (async_database_uri, async_engine_options, table_exists,
+                      tables_checked)
+from models import DataVersion, User, db
+from partitions import PARTITIONED_VIEW
+from queries import page_query, page_rows, transaction_summary
+from search import SEARCH_COLUMNS
+from serializers import NDJSON_MIMETYPE, encode_batch, stream_format
+from versions import data_versions_statement, versions_enabled, versions_of
+
+# ASGI entry point, run with
+#   gunicorn -w 4 -k uvicorn.workers.UvicornWorker asgi:application
+# /login and the read endpoints are served by coroutines reading the database
+# through an async engine, awaiting the password pool for bcrypt checks, so a
+# worker keeps serving other requests while queries and password checks are in
+# flight. They reuse the queries, serialization, caching and compression of
+# app.py. Every other request, exports included, goes to the Flask app running
+# in ASGI_WSGI_THREADS threads. Blocking calls, the response cache and the
+# checks of table_exists, run in the default executor of the event loop.
+
+engine = create_async_engine(async_database_uri(app.config),
+                             **async_engine_options(app.config))
+wsgi = WSGIMiddleware(app, workers=app.config['ASGI_WSGI_THREADS'])
+
+# Tables the coroutines check with table_exists, see check_tables.
+OPTIONAL_TABLES = (DataVersion.__tablename__, PARTITIONED_VIEW) + tuple(
+    table_name + "_fts" for table_name in SEARCH_COLUMNS)
+
+
+async def run_blocking(function, *args):
+    """
+    Coroutine used to run a blocking function in a thread of the event loop's default executor, with the context
+    of the current request.
+    """
+
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        None, functools.partial(contextvars.copy_context().run, function,
+                                *args))
+
+
+async def check_tables():
+    """
+    Coroutine used to let table_exists answer for OPTIONAL_TABLES from its cache, asking the database in a thread
+    at startup and after forget_tables, so versions_enabled, transaction_source and search_index_available never
+    block the event loop.
+    """
+
+    engine = db.engine
+    if not tables_checked(engine, OPTIONAL_TABLES):
+        await run_blocking(
+            lambda: [table_exists(engine, name) for name in OPTIONAL_TABLES])
+
+
+@instrumentation.timed("auth")
+async def login(conn):
+    """
+    Coroutine used to handle login of users, see app.login.
+    """
+
+    result = quickLogin(request)
+    if result is not None:
+        return result
+
+    credentials = request.get_json(silent=True)
+    user = (await conn.execute(
+        select(User.uuid,
+               User.password).where(User.username == credentials["username"])
+    )).first()
+    valid = user is not None and await asyncio.wrap_future(
+        password_pool.submit("check_password_hash", user.password,
+                             credentials["password"]))
+    return passwordLogin(user, credentials, valid)
+
+
+async def data_versions(conn, table_names):
+    """
+    Coroutine used to read the current version of tables, see versions.data_versions.
+    """
+
+    if not versions_enabled(db.engine):
+        return None
+    statement = data_versions_statement(table_names)
+    return versions_of(table_names, await conn.execute(statement))
+
+
+async def cached_response(conn, tables, build):
+    """
+    Coroutine used to answer a request from the response cache when possible, see app.cachedResponse.
+    """
+
+    if stream_format(request) is not None:
+        return await build()
+
+    encoding = responseEncoding()
+    versions = await data_versions(
+        conn, tables) if response_cache is not None else None
+    key, entry = await run_blocking(cacheLookup, versions, encoding)
+    if entry is None:
+        return await run_blocking(cacheStore, key, await build(), encoding)
+    return cacheHit(entry)
+
+
+async def stream_chunks(result, serialize, fmt, batch_size):
+    """
+    Async generator used to write the rows of a streamed result as they are read, see serializers.stream_rows.
+    """
+
+    if fmt == "json":
+        yield b"["
+    written = 0
+    async for rows in result.partitions(batch_size):
+        batch = [json_dumps(serialize(row)) for row in rows]
+        yield encode_batch(batch, fmt, written)
+        written += len(batch)
+    if fmt == "json":
+        yield b"]"
+
+
+async def paged_response(conn, query, keys, serialize):
+    """
+    Coroutine used to run the query of a list endpoint and send the requested page of rows, see app.pagedResponse.
+    """
+
+    fmt = stream_format(request)
+    query, limit = page_query(query, keys, request.args, fmt is not None)
+    if limit is None and fmt is not None:
+        result = await conn.stream(query.statement)
+        body = stream_chunks(result, serialize, fmt,
+                             app.config['STREAM_BATCH_SIZE'])
+        mimetype = NDJSON_MIMETYPE if fmt == "ndjson" else "application/json"
+        return Response(body, mimetype=mimetype)
+
+    rows = await fetch_all(conn, query.statement)
+    next_cursor = None
+    if limit is not None:
+        rows, next_cursor = page_rows(rows, limit,
+                                      lambda row: row[-len(keys):])
+    return listResponse(rows, serialize, next_cursor, fmt)
+
+
+@instrumentation.timed("query")
+async def fetch_all(conn, statement):
+    return (await conn.execute(statement)).all()
+
+
+def list_endpoint(tables, build_query):
+    """
+    Function used to build the coroutine of a list endpoint.
+
+    Args:
+        tables: names of the tables the endpoint reads.
+        build_query: app.patientsQuery, pharmaciesQuery or transactionsQuery.
+    """
+
+    async def endpoint(conn):
+        logged_in, msg = await login(conn)
+        if not logged_in:
+            return {"error": msg}
+        return await cached_response(
+            conn, tables, lambda: paged_response(conn, *build_query()))
+
+    return endpoint
+
+
+async def summary_endpoint(conn):
+    logged_in, msg = await login(conn)
+    if not logged_in:
+        return {"error": msg}
+
+    async def build():
+        query, labels = transaction_summary(request.args)
+        return summaryRows(await fetch_all(conn, query.statement), labels)
+
+    return await cached_response(conn, TRANSACTION_TABLES, build)
+
+
+async def token_endpoint(conn):
+    return tokenResult(*await login(conn))
+
+
+# Endpoints served by coroutines, all POST.
+ROUTES = {
+    "/login": token_endpoint,
+    "/patients": list_endpoint(("patients", ), patientsQuery),
+    "/pharmacies": list_endpoint(("pharmacies", ), pharmaciesQuery),
+    "/transactions": list_endpoint(TRANSACTION_TABLES, transactionsQuery),
+    "/transactions/summary": summary_endpoint,
+}
+
+
+def wsgi_environ(scope, body):
+    """
+    Function used to build the WSGI environ of an ASGI http request, so Flask can parse it.
+    """
+
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", "").encode().decode("latin1"),
+        "PATH_INFO": scope["path"].encode().decode("latin1"),
+        "QUERY_STRING": scope["query_string"].decode("latin1"),
+        "SERVER_PROTOCOL": "HTTP/" + scope["http_version"],
+        "SERVER_NAME": scope.get("server", ("localhost", 80))[0],
+        "SERVER_PORT": str(scope.get("server", ("localhost", 80))[1]),
+        "REMOTE_ADDR": (scope.get("client") or ("", 0))[0],
+        "CONTENT_LENGTH": str(len(body)),
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": BytesIO(body),
+        # flask logs the errors of the request to it, as text
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": False,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False,
+    }
+    for name, value in scope["headers"]:
+        name = name.decode("latin1")
+        if name == "content-length":
+            continue
+        if name == "content-type":
+            key = "CONTENT_TYPE"
+        else:
+            key = "HTTP_" + name.upper().replace("-", "_")
+        value = value.decode("latin1")
+        environ[key] = environ[key] + "," + value if key in environ else value
+    return environ
+
+
+async def read_body(receive):
+    chunks = []
+    while True:
+        message = await receive()
+        chunks.append(message.get("body", b""))
+        if not message.get("more_body"):
+            return b"".join(chunks)
+
+
+async def send_response(response, environ, send):
+    headers = response.get_wsgi_headers(environ)
+    await send({
+        "type":
+        "http.response.start",
+        "status":
+        response.status_code,
+        "headers": [(name.lower().encode("latin1"), value.encode("latin1"))
+                    for name, value in headers.items()],
+    })
+
+    if hasattr(response.response, "__aiter__"):
+        async for chunk in response.response:
+            await send({
+                "type": "http.response.body",
+                "body": chunk,
+                "more_body": True
+            })
+    else:
+        for chunk in response.get_app_iter(environ):
+            await send({
+                "type": "http.response.body",
+                "body": chunk,
+                "more_body": True
+            })
+    response.close()
+    await send({"type": "http.response.body"})
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            with app.app_context():
+                await check_tables()
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await engine.dispose()
+            password_pool.shutdown()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def application(scope, receive, send):
+    """
+    The ASGI application.
+    """
+
+    if scope["type"] == "lifespan":
+        return await lifespan(receive, send)
+
+    endpoint = None
+    if scope["type"] == "http" and scope["method"] == "POST":
+        endpoint = ROUTES.get(scope["path"])
+    query = parse_qs(scope.get("query_string", b"").decode("latin1"),
+                     keep_blank_values=True)
+    # exports and reads by id are only served by the Flask app
+    if endpoint is None or "format" in query or "ids" in query:
+        return await wsgi(scope, receive, send)
+
+    environ = wsgi_environ(scope, await read_body(receive))
+    with app.request_context(environ):
+        async with engine.connect() as conn:
+            try:
+                result = app.preprocess_request()
+                if result is None:
+                    await check_tables()
+                    result = await endpoint(conn)
+                response = app.make_response(result)
+            except Exception as error:
+                try:
+                    response = app.make_response(
+                        app.handle_user_exception(error))
+                except Exception as unhandled:
+                    response = app.make_response(
+                        app.handle_exception(unhandled))
+            response = app.process_response(response)
+            # streamed bodies keep reading from conn while they are sent
+            await send_response(response, environ, send)
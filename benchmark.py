@@ -0,0 +1,571 @@
+import http.client
+import json
+import math
+import os
+import platform
+import random
+import resource
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from itertools import islice
+
+import click
+from sqlalchemy import select
+
+from models import Patient, Pharmacy, Transaction, User
+from partitions import partitioned_view
+from rollups import ROLLUP_COLUMNS, rebuild_rollups
+
+# Benchmarks of the endpoints against a synthetic database:
+#   python benchmark.py seed --transactions 200000 bench.db
+#   python benchmark.py run bench.db --mode http --output new.json
+#   python benchmark.py compare old.json new.json
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+# Values of the synthetic rows, in the style of backend_test.db.
+FIRST_NAMES = ("JOANA", "GUSTAVO", "VITORIA", "ANTONIA", "LETICIA", "ROGERIO",
+               "STEPHANY", "CRISTIANO", "CARLOS", "ANTONIO", "ABEL",
+               "FERNANDA", "MARIA", "BEATRIZ", "ROBERTO", "LUCAS", "JULIA",
+               "PEDRO", "ANA", "MARCOS")
+LAST_NAMES = ("SILVA", "SALOMAO", "PEREIRA", "ABRAAO", "DONEGA", "FERREIRA",
+              "CARVALHO", "SANTOS", "TEIXEIRA", "MANCINI", "MARQUES",
+              "OLIVEIRA", "SOUZA", "LIMA", "COSTA", "ALMEIDA", "RIBEIRO",
+              "GOMES", "MARTINS", "ROCHA")
+PHARMACY_NAMES = ("DROGA MAIS", "DROGAO SUPER", "SUPER DROGAO",
+                  "DROGARIA SAO SIMAO", "DROGASIL", "DROGA RAIA",
+                  "PAGUE MENOS", "FARMA PONTE", "DROGARIA PACHECO", "FARMAIS")
+CITIES = ("RIBEIRAO PRETO", "SAO SIMAO", "LIMEIRA", "SAO PAULO", "CAMPINAS",
+          "ARARAQUARA", "FRANCA", "SAO CARLOS", "PIRACICABA", "BAURU")
+
+# Transactions are spread over these two years.
+FIRST_TIMESTAMP = datetime(2020, 1, 1)
+TIMESTAMP_SPAN = 2 * 365 * 24 * 3600
+
+BENCHMARK_USERNAME = "benchmark"
+BENCHMARK_PASSWORD = "benchmark-password"
+BENCHMARK_SECRET_KEY = "benchmark-secret-key"
+
+
+def row_ids(prefix, count):
+    width = max(4, len(str(count)))
+    return [f"{prefix}{i:0{width}d}" for i in range(1, count + 1)]
+
+
+def synthetic_rows(patients, pharmacies, transactions, seed):
+    """
+    Generator used to make the rows of a synthetic database, always the same ones for the same arguments.
+
+    Args:
+        patients, pharmacies, transactions: number of rows of each table.
+        seed: seed of the random values.
+
+    Yields:
+        (tuple) table and a dict with the values of one row, patients and pharmacies before the transactions
+        referencing them.
+    """
+
+    rng = random.Random(seed)
+    patient_ids = row_ids("PATIENT", patients)
+    for uuid in patient_ids:
+        yield Patient.__table__, {
+            "uuid":
+            uuid,
+            "first_name":
+            rng.choice(FIRST_NAMES),
+            "last_name":
+            rng.choice(LAST_NAMES),
+            "date_of_birth":
+            datetime(1950, 1, 1) + timedelta(days=rng.randrange(20000)),
+        }
+
+    pharmacy_ids = row_ids("PHARM", pharmacies)
+    for uuid in pharmacy_ids:
+        yield Pharmacy.__table__, {
+            "uuid": uuid,
+            "name": rng.choice(PHARMACY_NAMES),
+            "city": rng.choice(CITIES),
+        }
+
+    for uuid in row_ids("TRAN", transactions):
+        yield Transaction.__table__, {
+            "uuid":
+            uuid,
+            "patient_uuid":
+            rng.choice(patient_ids),
+            "pharmacy_uuid":
+            rng.choice(pharmacy_ids),
+            "amount":
+            round(rng.uniform(0.05, 50), 2),
+            "timestamp":
+            FIRST_TIMESTAMP + timedelta(seconds=rng.randrange(TIMESTAMP_SPAN)),
+        }
+
+
+def seed_database(conn,
+                  patients,
+                  pharmacies,
+                  transactions,
+                  seed=0,
+                  chunk_size=10000):
+    """
+    Function used to insert a synthetic database, chunk_size rows per executemany.
+
+    Args:
+        conn: connection to a database with empty patients, pharmacies and transactions tables.
+        patients, pharmacies, transactions: number of rows of each table.
+        seed: seed of the random values.
+        chunk_size: rows inserted per statement.
+    """
+
+    rows = synthetic_rows(patients, pharmacies, transactions, seed)
+    while True:
+        chunk = list(islice(rows, chunk_size))
+        if not chunk:
+            return
+        # a chunk can span two tables
+        for table in dict.fromkeys(table for table, _ in chunk):
+            conn.execute(
+                table.insert(),
+                [row for row_table, row in chunk if row_table is table])
+
+
+def scenarios():
+    """
+    Function used to list the requests of the benchmark, a mix of the filters clients send to each endpoint.
+
+    Returns:
+        (list) (name, function) pairs, the function takes a random.Random and returns the path, extra headers and
+        body of a request. Requests without a body are sent with the token of the benchmark user.
+    """
+
+    def year(rng):
+        return rng.randrange(1950, 2000)
+
+    def month(rng):
+        return f"202{rng.randrange(2)}-{rng.randrange(1, 13):02d}"
+
+    def export_month(month):
+        return (f"/transactions?format=csv&timestamp_from={month}-01"
+                f"&timestamp_to={month}-28", {}, None)
+
+    credentials = json.dumps({
+        "username": BENCHMARK_USERNAME,
+        "password": BENCHMARK_PASSWORD
+    }).encode()
+    json_headers = {"Content-Type": "application/json"}
+    ndjson = {"Accept": "application/x-ndjson"}
+    return [
+        ("index", lambda rng: ("/", {}, None)),
+        ("login", lambda rng: ("/login", json_headers, credentials)),
+        ("patients_page", lambda rng: ("/patients?limit=100", {}, None)),
+        ("patients_last_name", lambda rng:
+         (f"/patients?last_name={rng.choice(LAST_NAMES)}"
+          "&last_name_match=exact&limit=100", {}, None)),
+        ("patients_search", lambda rng:
+         (f"/patients?q={rng.choice(FIRST_NAMES)[:4]}&limit=100", {}, None)),
+        ("patients_dob_range", lambda rng:
+         (f"/patients?dob_from={year(rng)}-01-01&dob_to={year(rng) + 5}-12-31"
+          "&limit=100", {}, None)),
+        ("pharmacies_city", lambda rng:
+         (f"/pharmacies?city={rng.choice(CITIES).replace(' ', '+')}"
+          "&city_match=exact", {}, None)),
+        ("transactions_page", lambda rng:
+         ("/transactions?limit=100", {}, None)),
+        ("transactions_patient", lambda rng:
+         (f"/transactions?patient_last_name={rng.choice(LAST_NAMES)}"
+          "&patient_last_name_match=exact&limit=100", {}, None)),
+        ("transactions_city_month", lambda rng:
+         (f"/transactions?pharmacy_city={rng.choice(CITIES).replace(' ', '+')}"
+          f"&pharmacy_city_match=exact&timestamp_from={month(rng)}-01"
+          "&limit=1000", {}, None)),
+        ("transactions_fields", lambda rng:
+         ("/transactions?fields=id,amount,timestamp&limit=1000", {}, None)),
+        ("transactions_stream", lambda rng:
+         (f"/transactions?patient_first_name={rng.choice(FIRST_NAMES)}"
+          f"&patient_first_name_match=exact&timestamp_from={month(rng)}-01",
+          ndjson, None)),
+        ("summary_city", lambda rng:
+         ("/transactions/summary?group_by=city", {}, None)),
+        ("summary_month", lambda rng:
+         ("/transactions/summary?group_by=month&pharmacy_city="
+          f"{rng.choice(CITIES).replace(' ', '+')}", {}, None)),
+        ("export_csv", lambda rng: export_month(month(rng))),
+    ]
+
+
+def percentile(values, p):
+    """
+    Function used to get the p-th percentile, nearest rank, of sorted values.
+    """
+
+    if not values:
+        return None
+    return values[max(math.ceil(p / 100 * len(values)) - 1, 0)]
+
+
+def run_scenario(send, make_request, headers, count, concurrency, seed):
+    """
+    Function used to send count requests of a scenario from concurrency threads.
+
+    Args:
+        send: function sending a request, see client_sender and http_sender.
+        make_request: function of the scenario, see scenarios.
+        headers: headers sent with every request.
+        count: number of requests.
+        concurrency: number of threads sending them.
+        seed: seed of the random parameters of the requests.
+
+    Returns:
+        (dict) throughput, latency percentiles in milliseconds and number of responses of each status.
+    """
+
+    def worker(index):
+        rng = random.Random(f"{seed}-{index}")
+        latencies, statuses = [], {}
+        for _ in range(count // concurrency + (index < count % concurrency)):
+            path, extra_headers, body = make_request(rng)
+            start = time.perf_counter()
+            status, _ = send(path, {**headers, **extra_headers}, body)
+            latencies.append(time.perf_counter() - start)
+            statuses[str(status)] = statuses.get(str(status), 0) + 1
+        return latencies, statuses
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        results = list(executor.map(worker, range(concurrency)))
+    seconds = time.perf_counter() - start
+
+    latencies = sorted(latency for result, _ in results for latency in result)
+    statuses = {}
+    for _, counts in results:
+        for status, number in counts.items():
+            statuses[status] = statuses.get(status, 0) + number
+
+    def ms(value):
+        return round(value * 1000, 3) if value is not None else None
+
+    return {
+        "requests": len(latencies),
+        "errors": len(latencies) - statuses.get("200", 0),
+        "statuses": statuses,
+        "seconds": round(seconds, 3),
+        "req_per_s": round(len(latencies) / seconds, 2) if seconds else None,
+        "p50_ms": ms(percentile(latencies, 50)),
+        "p95_ms": ms(percentile(latencies, 95)),
+        "p99_ms": ms(percentile(latencies, 99)),
+        "max_ms": ms(latencies[-1] if latencies else None),
+    }
+
+
+def client_sender(app):
+    """
+    Function used to build a send function posting requests to the app in the same process, one test client per
+    thread. send returns the status and body of the response.
+    """
+
+    local = threading.local()
+
+    def send(path, headers, body):
+        if not hasattr(local, "client"):
+            local.client = app.test_client()
+        response = local.client.post(path, headers=headers, data=body)
+        data = response.get_data()
+        response.close()
+        return response.status_code, data
+
+    return send
+
+
+def http_sender(host, port):
+    """
+    Function used to build a send function posting requests to a server, one keep-alive connection per thread.
+    """
+
+    local = threading.local()
+
+    def send(path, headers, body):
+        if getattr(local, "conn", None) is None:
+            local.conn = http.client.HTTPConnection(host, port, timeout=120)
+        try:
+            local.conn.request("POST", path, body=body, headers=headers)
+            response = local.conn.getresponse()
+            data = response.read()
+        except (http.client.HTTPException, OSError):
+            local.conn.close()
+            local.conn = None
+            return None, None
+        return response.status, data
+
+    return send
+
+
+def peak_rss_mb(who):
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    rss = resource.getrusage(who).ru_maxrss
+    return round(rss / (2**20 if sys.platform == "darwin" else 2**10), 1)
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_server(port, workers, threads, asgi, env):
+    """
+    Function used to start gunicorn and wait until it answers.
+
+    Returns:
+        subprocess.Popen of the gunicorn master.
+    """
+
+    command = [sys.executable, "-m", "gunicorn", "-w", str(workers)]
+    if asgi:
+        command += ["-k", "uvicorn.workers.UvicornWorker", "asgi:application"]
+    else:
+        command += ["--threads", str(threads), "app:app"]
+    command += ["-b", f"127.0.0.1:{port}", "--log-level", "warning"]
+    server = subprocess.Popen(command, cwd=ROOT, env=env)
+
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise click.ClickException("gunicorn exited before serving")
+        try:
+            conn = http.client.HTTPConnection("127.0.0.1", port, timeout=1)
+            conn.request("GET", "/metrics")
+            if conn.getresponse().status == 200:
+                return server
+        except OSError:
+            time.sleep(0.2)
+    server.terminate()
+    raise click.ClickException("gunicorn didn't answer within 60 seconds")
+
+
+def benchmark_env(database, response_cache):
+    env = dict(os.environ,
+               DATABASE_URL="sqlite:///" + os.path.abspath(database),
+               SECRET_KEY=BENCHMARK_SECRET_KEY,
+               RESPONSE_CACHE_BACKEND=response_cache)
+    if response_cache == "sqlite":
+        env["RESPONSE_CACHE_PATH"] = os.path.abspath(database) + ".cache"
+    return env
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"],
+                              cwd=ROOT,
+                              capture_output=True,
+                              text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+@click.group()
+def cli():
+    pass
+
+
+@cli.command()
+@click.argument("database")
+@click.option("--patients", default=10000, show_default=True)
+@click.option("--pharmacies", default=500, show_default=True)
+@click.option("--transactions", default=200000, show_default=True)
+@click.option("--seed", default=0, show_default=True)
+def seed(database, patients, pharmacies, transactions, seed):
+    """
+    Create DATABASE, a sqlite file, with synthetic rows and the benchmark user.
+    """
+
+    if os.path.exists(database):
+        raise click.ClickException(f"{database} already exists")
+    os.environ.update(benchmark_env(database, "none"))
+    # the app reads its settings when imported
+    from app import app, bcrypt, db, upgrade_db
+
+    start = time.perf_counter()
+    with app.app_context():
+        upgrade_db(db.engine)
+        with db.engine.begin() as conn:
+            seed_database(conn, patients, pharmacies, transactions, seed)
+            # core inserts aren't seen by rollups.track_rollups
+            rebuild_rollups(
+                conn,
+                select(*[partitioned_view.c[name] for name in ROLLUP_COLUMNS]))
+            conn.execute(
+                User.__table__.insert(), {
+                    "uuid": "BENCHMARK",
+                    "username": BENCHMARK_USERNAME,
+                    "password":
+                    bcrypt.generate_password_hash(BENCHMARK_PASSWORD)
+                })
+            conn.exec_driver_sql("ANALYZE")
+    click.echo(f"seeded {database} in {time.perf_counter() - start:.1f}s")
+
+
+@cli.command()
+@click.argument("database")
+@click.option("--mode",
+              type=click.Choice(["client", "http"]),
+              default="client",
+              show_default=True,
+              help="app.test_client() in this process or HTTP to gunicorn.")
+@click.option("--asgi",
+              is_flag=True,
+              help="Run asgi.py with uvicorn workers in http mode.")
+@click.option("--requests",
+              default=200,
+              show_default=True,
+              help="Per scenario.")
+@click.option("--concurrency", default=4, show_default=True)
+@click.option("--warmup", default=5, show_default=True, help="Per scenario.")
+@click.option("--workers", default=4, show_default=True, help="gunicorn -w.")
+@click.option("--threads",
+              default=4,
+              show_default=True,
+              help="gunicorn --threads.")
+@click.option("--response-cache",
+              type=click.Choice(["none", "memory", "sqlite"]),
+              default="none",
+              show_default=True)
+@click.option("--accept-encoding", default="gzip", show_default=True)
+@click.option("--scenario",
+              "only",
+              multiple=True,
+              help="Run only these scenarios, repeatable.")
+@click.option("--seed", default=0, show_default=True)
+@click.option("--output", type=click.File("w"), default="-")
+def run(database, mode, asgi, requests, concurrency, warmup, workers, threads,
+        response_cache, accept_encoding, only, seed, output):
+    """
+    Benchmark every endpoint against DATABASE, made by the seed command, and write the results as json.
+    """
+
+    if not os.path.exists(database):
+        raise click.ClickException(
+            f"{database} doesn't exist, create it with the seed command")
+    env = benchmark_env(database, response_cache)
+    os.environ.update(env)
+    # the app reads its settings when imported
+    from app import app, db
+
+    with app.app_context():
+        counts = {
+            model.__tablename__: db.session.query(model).count()
+            for model in (Patient, Pharmacy, Transaction)
+        }
+
+    server = None
+    if mode == "http":
+        port = free_port()
+        server = start_server(port, workers, threads, asgi, env)
+        send = http_sender("127.0.0.1", port)
+    else:
+        send = client_sender(app)
+
+    try:
+        _, body = send(
+            "/login", {"Content-Type": "application/json"},
+            json.dumps({
+                "username": BENCHMARK_USERNAME,
+                "password": BENCHMARK_PASSWORD
+            }).encode())
+        token = json.loads(body or b"{}").get("token")
+        if token is None:
+            raise click.ClickException(f"login failed: {body}")
+        headers = {
+            "Authorization": "Bearer " + token,
+            "Accept-Encoding": accept_encoding
+        }
+
+        results = []
+        for name, make_request in scenarios():
+            if only and name not in only:
+                continue
+            if warmup:
+                run_scenario(send, make_request, headers, warmup, 1, seed)
+            result = run_scenario(send, make_request, headers, requests,
+                                  concurrency, seed)
+            results.append({"name": name, **result})
+            click.echo(
+                f"{name:25} {result['req_per_s']:>9} req/s  p50 {result['p50_ms']:>9} ms  "
+                f"p95 {result['p95_ms']:>9} ms  p99 {result['p99_ms']:>9} ms  "
+                f"errors {result['errors']}",
+                err=True)
+    finally:
+        if server is not None:
+            server.send_signal(signal.SIGTERM)
+            server.wait(60)
+
+    json.dump(
+        {
+            "commit":
+            git_commit(),
+            "started_at":
+            datetime.now().isoformat(timespec="seconds"),
+            "python":
+            platform.python_version(),
+            "mode":
+            mode,
+            "server": ("asgi" if asgi else "wsgi") if mode == "http" else None,
+            "database":
+            counts,
+            "settings": {
+                "requests": requests,
+                "concurrency": concurrency,
+                "warmup": warmup,
+                "workers": workers if mode == "http" else None,
+                "threads": threads if mode == "http" and not asgi else None,
+                "response_cache": response_cache,
+                "accept_encoding": accept_encoding,
+                "seed": seed,
+            },
+            "scenarios":
+            results,
+            # largest process: this one, or a gunicorn worker once they exited
+            "peak_rss_mb":
+            peak_rss_mb(resource.RUSAGE_CHILDREN if mode ==
+                        "http" else resource.RUSAGE_SELF),
+        },
+        output,
+        indent=2)
+    output.write("\n")
+
+
+@cli.command()
+@click.argument("base", type=click.File())
+@click.argument("new", type=click.File())
+def compare(base, new):
+    """
+    Show the change of throughput and latency of each scenario from the BASE results to the NEW ones.
+    """
+
+    def change(old, value):
+        if not old or value is None:
+            return ""
+        return f"({(value - old) / old:+.0%})"
+
+    base, new = json.load(base), json.load(new)
+    click.echo(f"{base['commit']} -> {new['commit']}")
+    old_results = {result["name"]: result for result in base["scenarios"]}
+    for result in new["scenarios"]:
+        old = old_results.get(result["name"], {})
+        line = f"{result['name']:25}"
+        for key in ("req_per_s", "p50_ms", "p95_ms", "p99_ms"):
+            line += f"  {key} {old.get(key)} -> {result[key]} {change(old.get(key), result[key]):8}"
+        click.echo(line)
+    click.echo(f"peak_rss_mb {base['peak_rss_mb']} -> {new['peak_rss_mb']} "
+               f"{change(base['peak_rss_mb'], new['peak_rss_mb'])}")
+
+
+if __name__ == "__main__":
+    cli()
@@ -0,0 +1,161 @@
+import zlib
+
+from serializers import NDJSON_MIMETYPE
+
+try:
+    import brotli
+except ImportError:  # optional, br is only offered when installed
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:  # optional, zstd is only offered when installed
+    zstandard = None
+
+# Mimetypes worth compressing besides text/*, zip files and the like aren't.
+COMPRESSIBLE_MIMETYPES = ('application/json', NDJSON_MIMETYPE)
+
+
+class ZlibCompressor:
+    """
+    gzip (wbits 31) or deflate (wbits 15) compressor.
+    """
+
+    def __init__(self, wbits):
+        self.obj = zlib.compressobj(6, zlib.DEFLATED, wbits)
+
+    def compress(self, data, flush=False):
+        out = self.obj.compress(data)
+        return out + self.obj.flush(zlib.Z_SYNC_FLUSH) if flush else out
+
+    def finish(self):
+        return self.obj.flush()
+
+
+class BrotliCompressor:
+
+    def __init__(self):
+        self.obj = brotli.Compressor(quality=5)
+
+    def compress(self, data, flush=False):
+        out = self.obj.process(data)
+        return out + self.obj.flush() if flush else out
+
+    def finish(self):
+        return self.obj.finish()
+
+
+class ZstdCompressor:
+
+    def __init__(self):
+        self.obj = zstandard.ZstdCompressor(level=3).compressobj()
+
+    def compress(self, data, flush=False):
+        out = self.obj.compress(data)
+        if flush:
+            out += self.obj.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+        return out
+
+    def finish(self):
+        return self.obj.flush()
+
+
+# Function creating a compressor for each Content-Encoding that can be used.
+COMPRESSORS = {
+    "gzip": lambda: ZlibCompressor(31),
+    "deflate": lambda: ZlibCompressor(15),
+}
+if brotli is not None:
+    COMPRESSORS["br"] = BrotliCompressor
+if zstandard is not None:
+    COMPRESSORS["zstd"] = ZstdCompressor
+
+
+def available_encodings(names):
+    """
+    Function used to keep the encodings of names, in order of preference, that can be used.
+    """
+
+    return tuple(name.strip() for name in names if name.strip() in COMPRESSORS)
+
+
+def compress(data, encoding):
+    compressor = COMPRESSORS[encoding]()
+    return compressor.compress(data) + compressor.finish()
+
+
+def compress_chunks(chunks, encoding):
+    """
+    Generator used to compress a streamed body, flushing after each chunk so the client can read the rows as they are
+    written.
+    """
+
+    compressor = COMPRESSORS[encoding]()
+    for chunk in chunks:
+        if isinstance(chunk, str):
+            chunk = chunk.encode('utf-8')
+        data = compressor.compress(chunk, flush=True)
+        if data:
+            yield data
+    yield compressor.finish()
+
+
+async def compress_async_chunks(chunks, encoding):
+    """
+    Async generator used to compress a streamed body read from an async iterable, see compress_chunks.
+    """
+
+    compressor = COMPRESSORS[encoding]()
+    async for chunk in chunks:
+        data = compressor.compress(chunk, flush=True)
+        if data:
+            yield data
+    yield compressor.finish()
+
+
+def compressible(response):
+    return (response.status_code == 200 and not response.direct_passthrough
+            and "Content-Encoding" not in response.headers
+            and (response.mimetype.startswith("text/")
+                 or response.mimetype in COMPRESSIBLE_MIMETYPES))
+
+
+def compress_response(response, encoding, min_size):
+    """
+    Function used to compress the body of a response with the encoding negotiated with the client.
+
+    Buffered bodies smaller than min_size are sent as they are. Streamed bodies are compressed chunk by chunk. The
+    ETag of a compressed response is made weak, since it was computed from the uncompressed body.
+
+    Args:
+        response: Flask response, left untouched if it isn't a compressible 200 or is already encoded.
+        encoding: key of COMPRESSORS, or None if the client accepts none of them.
+        min_size: smallest buffered body that gets compressed, in bytes.
+
+    Returns:
+        The same response.
+    """
+
+    if not compressible(response):
+        return response
+    response.vary.add("Accept-Encoding")
+    if encoding is None:
+        return response
+
+    if response.is_streamed:
+        if hasattr(response.response, "__aiter__"):
+            response.response = compress_async_chunks(response.response,
+                                                      encoding)
+        else:
+            response.response = compress_chunks(response.response, encoding)
+    else:
+        body = response.get_data()
+        if len(body) < min_size:
+            return response
+        response.set_data(compress(body, encoding))
+
+    response.headers["Content-Encoding"] = encoding
+    etag, weak = response.get_etag()
+    if etag is not None and not weak:
+        response.set_etag(etag, weak=True)
+    return response
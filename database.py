@@ -0,0 +1,147 @@
+import sqlite3
+
+from sqlalchemy import event, inspect
+from sqlalchemy.dialects.sqlite.aiosqlite import \
+    AsyncAdapt_aiosqlite_connection
+from sqlalchemy.engine import Engine, make_url
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool, StaticPool
+
+# async drivers used by asgi.py for each database backend
+ASYNC_DRIVERS = {"sqlite": "aiosqlite", "postgresql": "asyncpg"}
+
+_existing_tables = {}
+
+
+def engine_options(config):
+    """
+    Function used to build the SQLAlchemy engine options for the configured database.
+
+    In-memory SQLite databases share a single connection so every thread sees the same data. SQLite files and other
+    databases get a connection pool, SQLAlchemy would otherwise open a new SQLite connection for every checkout.
+
+    Args:
+        config: app config.
+
+    Returns:
+        (dict) keyword arguments for sqlalchemy.create_engine.
+    """
+
+    url = make_url(config['SQLALCHEMY_DATABASE_URI'])
+    if url.get_backend_name() != "sqlite":
+        return {
+            "pool_size": config['DB_POOL_SIZE'],
+            "max_overflow": config['DB_MAX_OVERFLOW'],
+            "pool_timeout": config['DB_POOL_TIMEOUT'],
+            "pool_recycle": config['DB_POOL_RECYCLE'],
+            "pool_pre_ping": config['DB_POOL_PRE_PING'],
+        }
+
+    connect_args = {
+        "check_same_thread": False,
+        "timeout": config['SQLITE_BUSY_TIMEOUT'] / 1000
+    }
+    if url.database in (None, "", ":memory:"):
+        return {"poolclass": StaticPool, "connect_args": connect_args}
+    return {
+        "poolclass": QueuePool,
+        "pool_size": config['DB_POOL_SIZE'],
+        "max_overflow": config['DB_MAX_OVERFLOW'],
+        "pool_timeout": config['DB_POOL_TIMEOUT'],
+        "connect_args": connect_args,
+    }
+
+
+def async_database_uri(config):
+    """
+    Function used to get the url of the async engine, ASYNC_DATABASE_URL or SQLALCHEMY_DATABASE_URI with the async
+    driver of its backend.
+    """
+
+    if config['ASYNC_DATABASE_URL']:
+        return config['ASYNC_DATABASE_URL']
+    url = make_url(config['SQLALCHEMY_DATABASE_URI'])
+    backend = url.get_backend_name()
+    if backend not in ASYNC_DRIVERS:
+        raise ValueError(f"set ASYNC_DATABASE_URL to use {backend} with asgi")
+    return str(url.set(drivername=f"{backend}+{ASYNC_DRIVERS[backend]}"))
+
+
+def async_engine_options(config):
+    """
+    Function used to build the options of the async engine, the same pool settings as engine_options.
+
+    Returns:
+        (dict) keyword arguments for sqlalchemy.ext.asyncio.create_async_engine.
+    """
+
+    options = engine_options(config)
+    if options.get("poolclass") is QueuePool:
+        options["poolclass"] = AsyncAdaptedQueuePool
+    return options
+
+
+def install_sqlite_pragmas(config):
+    """
+    Function used to set the journal mode, synchronous and busy timeout pragmas on every new SQLite connection.
+
+    WAL lets readers run while /register writes instead of failing with "database is locked", and synchronous
+    NORMAL is safe with WAL while syncing far less often.
+
+    Args:
+        config: app config.
+    """
+
+    pragmas = (
+        ("journal_mode", config['SQLITE_JOURNAL_MODE']),
+        ("synchronous", config['SQLITE_SYNCHRONOUS']),
+        ("busy_timeout", int(config['SQLITE_BUSY_TIMEOUT'])),
+    )
+
+    @event.listens_for(Engine, "connect")
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        if not isinstance(
+                dbapi_connection,
+            (sqlite3.Connection, AsyncAdapt_aiosqlite_connection)):
+            return
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas:
+            cursor.execute(f"PRAGMA {name} = {value}")
+        cursor.close()
+
+
+def table_exists(engine, table_name):
+    """
+    Function used to check if a table exists, the answer is cached until forget_tables is called.
+
+    Lets optional tables, like the ones created by flask upgrade-db, be used only once they exist without asking
+    the database on every request.
+
+    Args:
+        engine: engine of the database.
+        table_name: name of the table.
+
+    Returns:
+        (bool) True if the table exists.
+    """
+
+    key = (engine.url, table_name)
+    if key not in _existing_tables:
+        _existing_tables[key] = inspect(engine).has_table(table_name)
+    return _existing_tables[key]
+
+
+def tables_checked(engine, table_names):
+    """
+    Function used to know if table_exists can answer for all of table_names from its cache, without asking the
+    database.
+    """
+
+    return all((engine.url, name) in _existing_tables for name in table_names)
+
+
+def forget_tables():
+    """
+    Function used to clear the cache of table_exists after tables are created or dropped.
+    """
+
+    _existing_tables.clear()
@@ -0,0 +1,143 @@
+import csv
+import io
+import zipfile
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+except ImportError:  # optional, only the csv export is available without it
+    pyarrow = None
+
+EXPORT_MIMETYPE = 'application/zip'
+
+# Columns of each exported table, the same fields /import reads.
+EXPORT_FIELDS = {
+    "transactions": ("id", "patient_id", "pharmacy_id", "amount", "timestamp"),
+    "patients": ("id", "first_name", "last_name", "date_of_birth"),
+    "pharmacies": ("id", "name", "city"),
+}
+
+
+def export_formats():
+    return ("csv", "arrow") if pyarrow is not None else ("csv", )
+
+
+class ChunkWriter:
+    """
+    Write only file collecting what is written to it until it is drained, used to stream a zip file.
+    """
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+
+class CsvTable:
+    """
+    Table written to a zip member as csv with a header line.
+    """
+
+    def __init__(self, member, name):
+        self.file = io.TextIOWrapper(member, encoding='utf-8', newline='')
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(EXPORT_FIELDS[name])
+
+    def write(self, rows):
+        self.writer.writerows(rows)
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class ArrowTable:
+    """
+    Table written to a zip member as an Arrow IPC stream, one record batch per write.
+    """
+
+    def __init__(self, member, name):
+        self.member = member
+        self.schema = arrow_schema(name)
+        self.writer = pyarrow.ipc.new_stream(member, self.schema)
+
+    def write(self, rows):
+        columns = list(zip(*rows))
+        self.writer.write_batch(
+            pyarrow.record_batch(columns, schema=self.schema))
+
+    def close(self):
+        self.writer.close()
+        self.member.close()
+
+
+def arrow_schema(name):
+    string, timestamp = pyarrow.string(), pyarrow.timestamp('us')
+    types = {
+        "amount": pyarrow.float64(),
+        "timestamp": timestamp,
+        "date_of_birth": timestamp
+    }
+    return pyarrow.schema([(field, types.get(field, string))
+                           for field in EXPORT_FIELDS[name]])
+
+
+def export_transactions(rows, fmt, batch_size):
+    """
+    Generator used to write transactions as a zip file with one normalized table per member.
+
+    Instead of repeating the patient and pharmacy of every transaction, transactions.csv (or .arrow) references them
+    by id, and each patient and pharmacy is written once to patients.csv and pharmacies.csv after the last
+    transaction. The members have the fields /import reads, so an export can be loaded back.
+
+    Args:
+        rows: iterable of rows with the columns of queries.transaction_columns, usually a query with yield_per.
+        fmt: 'csv' or 'arrow', which needs pyarrow and expects the dates not to be formatted.
+        batch_size: number of rows written per chunk.
+
+    Yields:
+        (bytes) chunks of the zip file.
+    """
+
+    table_class = ArrowTable if fmt == "arrow" else CsvTable
+    out = ChunkWriter()
+    archive = zipfile.ZipFile(out, 'w', zipfile.ZIP_DEFLATED)
+
+    def table(name):
+        return table_class(archive.open(f"{name}.{fmt}", 'w'), name)
+
+    patients, pharmacies = {}, {}
+    transactions = table("transactions")
+    batch = []
+    for row in rows:
+        batch.append((row[0], row[3], row[7], row[1], row[2]))
+        patients[row[3]] = row[3:7]
+        pharmacies[row[7]] = row[7:10]
+        if len(batch) == batch_size:
+            transactions.write(batch)
+            batch = []
+            yield out.drain()
+    if batch:
+        transactions.write(batch)
+    transactions.close()
+
+    for name, values in (("patients", patients), ("pharmacies", pharmacies)):
+        values = list(values.values())
+        members = table(name)
+        for start in range(0, len(values), batch_size):
+            members.write(values[start:start + batch_size])
+            yield out.drain()
+        members.close()
+
+    archive.close()
+    yield out.drain()
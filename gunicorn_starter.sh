@@ -1,4 +1,15 @@
 #!/bin/sh
 
+# Auth tokens are signed with SECRET_KEY, every worker needs the same one.
+export SECRET_KEY=${SECRET_KEY:-$(python -c 'import secrets; print(secrets.token_hex(32))')}
+
+# Creates any table or index missing from the database, existing data is kept.
+FLASK_APP=app flask upgrade-db
+
 # Here we will be spinning up multiple threads with multiple worker processess(-w) and perform a binding.
-gunicorn -w 4 --threads 4 -b 0.0.0.0:5000 app:app
\ No newline at end of file
+# SERVER_MODE=asgi runs asgi.py instead, with an event loop per worker.
+if [ "$SERVER_MODE" = "asgi" ]; then
+    gunicorn -w 4 -k uvicorn.workers.UvicornWorker -b 0.0.0.0:5000 asgi:application
+else
+    gunicorn -w 4 --threads 4 -b 0.0.0.0:5000 app:app
+fi
@@ -0,0 +1,241 @@
+import csv
+import json
+from datetime import datetime
+from itertools import islice
+
+from models import Patient, Pharmacy, Transaction, db
+from partitions import transaction_source
+
+# Formats accepted for dates, besides ISO, so /patients and /transactions
+# exports can be loaded back.
+DATE_FORMATS = ('%m/%d/%Y %H:%M:%S', '%m/%d/%Y')
+
+# Rejected rows reported back per chunk, the count is always exact.
+MAX_REPORTED_ERRORS = 20
+
+# Ids looked up per query, below the 999 bound parameters older SQLite builds
+# accept in a statement.
+LOOKUP_BATCH_SIZE = 900
+
+
+class RecordError(ValueError):
+    """
+    Raised when a record can't be converted into a row, the record is skipped and the message reported.
+    """
+
+
+def parse_datetime(value, name):
+    try:
+        return datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        pass
+    for fmt in DATE_FORMATS:
+        try:
+            return datetime.strptime(value, fmt)
+        except (TypeError, ValueError):
+            pass
+    raise RecordError(f"{name} must be a date in the format year-month-day")
+
+
+def required(record, name):
+    value = record.get(name)
+    if value is None or str(value).strip() == "":
+        raise RecordError(f"missing {name}")
+    return str(value).strip()
+
+
+def patient_row(record):
+    return {
+        "uuid":
+        required(record, "id"),
+        "first_name":
+        required(record, "first_name"),
+        "last_name":
+        required(record, "last_name"),
+        "date_of_birth":
+        parse_datetime(required(record, "date_of_birth"), "date_of_birth"),
+    }
+
+
+def pharmacy_row(record):
+    return {
+        "uuid": required(record, "id"),
+        "name": required(record, "name"),
+        "city": required(record, "city"),
+    }
+
+
+def transaction_row(record):
+    try:
+        amount = float(required(record, "amount"))
+    except ValueError:
+        raise RecordError("amount must be a number")
+    return {
+        "uuid": required(record, "id"),
+        "patient_uuid": required(record, "patient_id"),
+        "pharmacy_uuid": required(record, "pharmacy_id"),
+        "amount": amount,
+        "timestamp": parse_datetime(required(record, "timestamp"),
+                                    "timestamp"),
+    }
+
+
+# Model and record converter of each table that can be imported, records use
+# the same field names as the list endpoints.
+IMPORTS = {
+    "patients": (Patient, patient_row),
+    "pharmacies": (Pharmacy, pharmacy_row),
+    "transactions": (Transaction, transaction_row),
+}
+
+# Foreign keys checked before inserting, as (row key, referenced model).
+FOREIGN_KEYS = {
+    "transactions": (("patient_uuid", Patient), ("pharmacy_uuid", Pharmacy)),
+}
+
+
+def read_records(lines, fmt):
+    """
+    Generator used to parse an uploaded file one record at a time.
+
+    Args:
+        lines: iterable over the lines of the file, as bytes or str.
+        fmt: 'csv', with a header line, or 'ndjson'.
+
+    Yields:
+        (int) line number of the record.
+        (dict) the record, or a RecordError if the line can't be parsed.
+    """
+
+    lines = (line.decode('utf-8') if isinstance(line, bytes) else line
+             for line in lines)
+
+    if fmt == "csv":
+        reader = csv.DictReader(lines)
+        for record in reader:
+            yield reader.line_num, record
+        return
+
+    for line_num, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError:
+            record = RecordError("invalid json")
+        if not isinstance(record, (dict, RecordError)):
+            record = RecordError("each line must be a json object")
+        yield line_num, record
+
+
+def existing_uuids(model, uuids):
+    """
+    Function used to find which of uuids are already in the table of model, with one query per LOOKUP_BATCH_SIZE
+    uuids.
+    """
+
+    found = set()
+    for start in range(0, len(uuids), LOOKUP_BATCH_SIZE):
+        batch = uuids[start:start + LOOKUP_BATCH_SIZE]
+        rows = db.session.query(model.uuid).filter(model.uuid.in_(batch))
+        found.update(uuid for uuid, in rows)
+    return found
+
+
+def import_chunk(table_name, records, known_keys):
+    """
+    Function used to validate and insert one chunk of records in a single transaction.
+
+    Duplicated ids and unknown foreign keys are looked up for the whole chunk at once, never row by row. Rows that
+    fail validation are skipped and reported, the others are inserted with a single executemany.
+
+    Args:
+        table_name: key of IMPORTS.
+        records: list of (line number, record) pairs.
+        known_keys: dict of sets with the foreign keys already found to exist, shared between the chunks of an import.
+
+    Returns:
+        (int) number of rows inserted.
+        (list) (line number, error message) of the rejected records.
+    """
+
+    model, convert = IMPORTS[table_name]
+    rows, errors = [], []
+    for line_num, record in records:
+        try:
+            if isinstance(record, RecordError):
+                raise record
+            rows.append((line_num, convert(record)))
+        except RecordError as error:
+            errors.append((line_num, str(error)))
+
+    # transactions moved to partitions are taken too
+    source = transaction_source(db.engine) if model is Transaction else model
+    taken = existing_uuids(source, list({row["uuid"] for _, row in rows}))
+    missing = {}
+    for key, referenced in FOREIGN_KEYS.get(table_name, ()):
+        known = known_keys.setdefault(key, set())
+        unknown = list({row[key] for _, row in rows} - known)
+        found = existing_uuids(referenced, unknown)
+        known.update(found)
+        missing[key] = set(unknown) - found
+
+    valid = []
+    for line_num, row in rows:
+        if row["uuid"] in taken:
+            errors.append((line_num, f"id {row['uuid']} already exists"))
+            continue
+        bad_keys = [key for key in missing if row[key] in missing[key]]
+        if bad_keys:
+            errors.append(
+                (line_num, f"{bad_keys[0]} {row[bad_keys[0]]} doesn't exist"))
+            continue
+        taken.add(row["uuid"])
+        valid.append(row)
+
+    if valid:
+        db.session.execute(model.__table__.insert(), valid)
+    db.session.commit()
+    return len(valid), sorted(errors)
+
+
+def import_records(table_name, records, chunk_size, on_chunk=None):
+    """
+    Function used to import a stream of records into a table, chunk_size records per transaction.
+
+    Args:
+        table_name: key of IMPORTS.
+        records: iterable of (line number, record) pairs, see read_records.
+        chunk_size: number of records per chunk.
+        on_chunk: optional function called with the report of each chunk as soon as it is committed.
+
+    Returns:
+        (dict) totals of the import and the report of each chunk.
+    """
+
+    report = {"inserted": 0, "rejected": 0, "chunks": []}
+    known_keys = {}
+    records = iter(records)
+    while True:
+        chunk = list(islice(records, chunk_size))
+        if not chunk:
+            return report
+
+        inserted, errors = import_chunk(table_name, chunk, known_keys)
+        chunk_report = {
+            "chunk":
+            len(report["chunks"]) + 1,
+            "inserted":
+            inserted,
+            "rejected":
+            len(errors),
+            "errors": [{
+                "line": line_num,
+                "error": error
+            } for line_num, error in errors[:MAX_REPORTED_ERRORS]],
+        }
+        report["inserted"] += inserted
+        report["rejected"] += len(errors)
+        report["chunks"].append(chunk_report)
+        if on_chunk is not None:
+            on_chunk(chunk_report)
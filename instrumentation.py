@@ -0,0 +1,183 @@
+import inspect
+import time
+from functools import wraps
+
+from flask import g, has_app_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from metrics import Histogram
+
+# Buckets of the number of SQL statements executed by a request.
+SQL_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+
+class RequestTimings:
+    """
+    Time spent by a request in each phase and in SQL, kept in flask.g while instrumentation is enabled.
+    """
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.phases = {}
+        self.sql_count = 0
+        self.sql_seconds = 0.0
+
+    def add(self, phase, seconds):
+        self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+
+    def merge(self, other):
+        # timings of work done for this request in another thread
+        for phase, seconds in other.phases.items():
+            self.add(phase, seconds)
+        self.sql_count += other.sql_count
+        self.sql_seconds += other.sql_seconds
+
+    def server_timing(self):
+        """
+        Returns the value of the Server-Timing header, with durations in milliseconds.
+        """
+
+        total = time.perf_counter() - self.start
+        metrics = [
+            f"{phase};dur={seconds * 1000:.2f}"
+            for phase, seconds in self.phases.items()
+        ]
+        metrics.append(f'sql;dur={self.sql_seconds * 1000:.2f};'
+                       f'desc="{self.sql_count} queries"')
+        metrics.append(f"total;dur={total * 1000:.2f}")
+        return ", ".join(metrics)
+
+
+def current_timings():
+    return g.get("request_timings") if has_app_context() else None
+
+
+class Instrumentation:
+    """
+    Optional timing of the requests, off unless enable is called.
+
+    While enabled every request gets a Server-Timing header with the time spent in each phase decorated with timed
+    (auth, query, serialize...), the number and duration of its SQL statements and its total time, and the
+    registry gets histograms of the request durations and SQL statements per route. While disabled no hook or
+    engine listener is installed and timed functions only check a flag before running.
+
+    Args:
+        registry: metrics.MetricsRegistry the histograms are added to.
+    """
+
+    def __init__(self, registry):
+        self.enabled = False
+        self.request_seconds = registry.add(
+            Histogram(
+                "http_request_duration_seconds",
+                "Time spent answering requests, streamed bodies included.",
+                ("route", "method", "status")))
+        self.sql_queries = registry.add(
+            Histogram("http_request_sql_queries",
+                      "SQL statements executed per request.", ("route", ),
+                      SQL_COUNT_BUCKETS))
+        self.sql_seconds = registry.add(
+            Histogram("http_request_sql_seconds",
+                      "Time spent executing SQL statements per request.",
+                      ("route", )))
+
+    def timed(self, phase):
+        """
+        Decorator used to add the time spent in a function, or coroutine function, to a phase of the Server-Timing
+        header.
+        """
+
+        def decorator(function):
+            if inspect.iscoroutinefunction(function):
+                return self.timed_coroutine(phase, function)
+
+            @wraps(function)
+            def wrapper(*args, **kwargs):
+                timings = current_timings() if self.enabled else None
+                if timings is None:
+                    return function(*args, **kwargs)
+                start = time.perf_counter()
+                try:
+                    return function(*args, **kwargs)
+                finally:
+                    timings.add(phase, time.perf_counter() - start)
+
+            return wrapper
+
+        return decorator
+
+    def timed_coroutine(self, phase, function):
+
+        @wraps(function)
+        async def wrapper(*args, **kwargs):
+            timings = current_timings() if self.enabled else None
+            if timings is None:
+                return await function(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return await function(*args, **kwargs)
+            finally:
+                timings.add(phase, time.perf_counter() - start)
+
+        return wrapper
+
+    def enable(self, app):
+        """
+        Function used to install the request hooks and the SQL listeners.
+
+        The hooks are put first in the app's lists, so the timing starts before any other before_request function
+        and the header is set after every other after_request function, compression included.
+        """
+
+        app.before_request_funcs.setdefault(None,
+                                            []).insert(0, self.start_request)
+        app.after_request_funcs.setdefault(None,
+                                           []).insert(0, self.finish_request)
+        event.listen(Engine, "before_cursor_execute",
+                     self.before_cursor_execute)
+        event.listen(Engine, "after_cursor_execute", self.after_cursor_execute)
+        self.enabled = True
+
+    def disable(self, app):
+        self.enabled = False
+        app.before_request_funcs[None].remove(self.start_request)
+        app.after_request_funcs[None].remove(self.finish_request)
+        event.remove(Engine, "before_cursor_execute",
+                     self.before_cursor_execute)
+        event.remove(Engine, "after_cursor_execute", self.after_cursor_execute)
+
+    def start_request(self):
+        g.request_timings = RequestTimings()
+
+    def finish_request(self, response):
+        timings = current_timings()
+        if timings is None:
+            return response
+        response.headers["Server-Timing"] = timings.server_timing()
+
+        route = request.url_rule.rule if request.url_rule else "unmatched"
+        labels = (route, request.method, str(response.status_code))
+
+        def observe():
+            # once the body is sent, so streamed rows are counted too
+            self.request_seconds.observe(time.perf_counter() - timings.start,
+                                         *labels)
+            self.sql_queries.observe(timings.sql_count, route)
+            self.sql_seconds.observe(timings.sql_seconds, route)
+
+        response.call_on_close(observe)
+        return response
+
+    def before_cursor_execute(self, conn, cursor, statement, parameters,
+                              context, executemany):
+        if current_timings() is not None:
+            context._instrumentation_start = time.perf_counter()
+
+    def after_cursor_execute(self, conn, cursor, statement, parameters,
+                             context, executemany):
+        start = getattr(context, "_instrumentation_start", None)
+        timings = current_timings()
+        if start is not None and timings is not None:
+            timings.sql_count += 1
+            timings.sql_seconds += time.perf_counter() - start
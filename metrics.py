@@ -0,0 +1,151 @@
+import bisect
+import threading
+
+PROMETHEUS_MIMETYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Upper bounds, in seconds, of the histogram buckets.
+DEFAULT_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+
+LABEL_ESCAPES = str.maketrans({"\\": "\\\\", '"': '\\"', "\n": "\\n"})
+
+
+def number_text(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def labels_text(names, values):
+    if not names:
+        return ""
+    return "{" + ",".join(f'{name}="{str(value).translate(LABEL_ESCAPES)}"'
+                          for name, value in zip(names, values)) + "}"
+
+
+class Counter:
+    """
+    Counter of events, one value per combination of label values.
+
+    Args:
+        name: metric name, ending in '_total' by convention.
+        help: description shown by Prometheus.
+        labels: names of the labels, inc takes their values in the same order.
+    """
+
+    kind = "counter"
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values,
+                                                          0) + amount
+
+    def value(self, *label_values):
+        return self._values.get(label_values, 0)
+
+    def samples(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        for label_values, value in values:
+            yield self.name + labels_text(self.labels, label_values), value
+
+
+class Gauge:
+    """
+    Value read when the metrics are rendered, e.g. the length of a queue.
+
+    Args:
+        name: metric name.
+        help: description shown by Prometheus.
+        read: function returning the current value.
+    """
+
+    kind = "gauge"
+
+    def __init__(self, name, help, read):
+        self.name = name
+        self.help = help
+        self.read = read
+
+    def samples(self):
+        yield self.name, self.read()
+
+
+class Histogram:
+    """
+    Distribution of observed values, e.g. durations in seconds, counted in cumulative buckets.
+
+    Args:
+        name: metric name.
+        help: description shown by Prometheus.
+        labels: names of the labels, observe takes their values in the same order.
+        buckets: sorted upper bounds of the buckets, a last +Inf bucket is always added.
+    """
+
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = tuple(buckets)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(label_values)
+            if counts is None:
+                # one count per bucket, then the +Inf bucket and the sum
+                counts = self._values[label_values] = [0] * (
+                    len(self.buckets) + 1) + [0.0]
+            counts[index] += 1
+            counts[-1] += value
+
+    def count(self, *label_values):
+        counts = self._values.get(label_values)
+        return sum(counts[:-1]) if counts is not None else 0
+
+    def samples(self):
+        with self._lock:
+            values = sorted((label_values, list(counts))
+                            for label_values, counts in self._values.items())
+        labels = self.labels + ("le", )
+        for label_values, counts in values:
+            total = 0
+            for bound, count in zip(self.buckets + (float("inf"), ), counts):
+                total += count
+                yield self.name + "_bucket" + labels_text(
+                    labels, label_values + (number_text(bound), )), total
+            text = labels_text(self.labels, label_values)
+            yield self.name + "_sum" + text, counts[-1]
+            yield self.name + "_count" + text, total
+
+
+class MetricsRegistry:
+    """
+    Metrics of a worker process, rendered in the Prometheus text format.
+    """
+
+    def __init__(self):
+        self.metrics = []
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(f"{name} {number_text(value)}"
+                         for name, value in metric.samples())
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,51 @@
+from sqlalchemy import inspect, select
+
+from database import forget_tables
+from models import TransactionRollup, db
+from partitions import create_partitioned_view, partitioned_view
+from rollups import ROLLUP_COLUMNS, rebuild_rollups
+from search import create_search_indexes
+from versions import seed_data_versions
+
+
+def upgrade_db(engine):
+    """
+    Function used to bring an existing database up to date with the models without rebuilding it.
+
+    Creates the tables and indexes declared in models.py that are missing, plus the full-text search indexes and the
+    view of the transaction partitions, and leaves everything else, including the data, untouched, so it is safe to
+    run on every start. The rollup table is filled when it is created.
+
+    Args:
+        engine: engine of the database to upgrade.
+
+    Returns:
+        (list) names of the indexes created.
+    """
+
+    new_rollups = not inspect(engine).has_table(
+        TransactionRollup.__tablename__)
+    db.metadata.create_all(engine)
+
+    created = []
+    with engine.begin() as conn:
+        for table in db.metadata.sorted_tables:
+            for index in sorted(table.indexes, key=lambda index: index.name):
+                if not engine.dialect.has_index(conn, table.name, index.name):
+                    index.create(conn)
+                    created.append(index.name)
+        created.extend(create_search_indexes(conn))
+        seed_data_versions(conn)
+        create_partitioned_view(conn)
+        if new_rollups:
+            forget_tables()
+            rebuild_rollups(
+                conn,
+                select(*[partitioned_view.c[name] for name in ROLLUP_COLUMNS]))
+
+        # refresh the statistics sqlite's planner uses to choose indexes
+        if created and engine.dialect.name == "sqlite":
+            conn.exec_driver_sql("ANALYZE")
+
+    forget_tables()
+    return created
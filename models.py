@@ -15,15 +15,24 @@ class User(db.Model):
 
 class Patient(db.Model):
     __tablename__ = "patients"
+    __table_args__ = (
+        # matches the order of /patients and /transactions and their cursors
+        db.Index("ix_patients_first_name_uuid", "first_name", "uuid"), )
     uuid = db.Column(db.String(256), primary_key=True)
     first_name = db.Column(db.String(30), nullable=False)
-    last_name = db.Column(db.String(30), nullable=False)
-    date_of_birth = db.Column(db.DateTime, nullable=False)
+    last_name = db.Column(db.String(30), nullable=False, index=True)
+    date_of_birth = db.Column(db.DateTime, nullable=False, index=True)
     transactions = db.relationship("Transaction", backref="patient")
 
 
 class Pharmacy(db.Model):
     __tablename__ = "pharmacies"
+    __table_args__ = (
+        # matches the order of /pharmacies and its cursors
+        db.Index("ix_pharmacies_name_uuid", "name", "uuid"),
+        # city filter already sorted by name
+        db.Index("ix_pharmacies_city_name", "city", "name"),
+    )
     uuid = db.Column(db.String(256), primary_key=True)
     name = db.Column(db.String(50), nullable=False)
     city = db.Column(db.String(50), nullable=False)
@@ -32,6 +41,13 @@ class Pharmacy(db.Model):
 
 class Transaction(db.Model):
     __tablename__ = "transactions"
+    __table_args__ = (
+        # foreign key lookups, optionally narrowed by time
+        db.Index("ix_transactions_patient_uuid_timestamp", "patient_uuid",
+                 "timestamp"),
+        db.Index("ix_transactions_pharmacy_uuid_timestamp", "pharmacy_uuid",
+                 "timestamp"),
+    )
     uuid = db.Column(db.String(256), primary_key=True)
     patient_uuid = db.Column(db.String(256),
                              db.ForeignKey("patients.uuid"),
@@ -39,5 +55,27 @@ class Transaction(db.Model):
     pharmacy_uuid = db.Column(db.String(256),
                               db.ForeignKey("pharmacies.uuid"),
                               nullable=False)
+    amount = db.Column(db.Float, nullable=False, index=True)
+    timestamp = db.Column(db.DateTime, nullable=False, index=True)
+
+
+class DataVersion(db.Model):
+    __tablename__ = "data_versions"
+    table_name = db.Column(db.String(50), primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+
+
+# Daily and monthly count and sum of the transaction amounts of each pharmacy
+# and patient, kept up to date by rollups.track_rollups.
+class TransactionRollup(db.Model):
+    __tablename__ = "transaction_rollups"
+    __table_args__ = (
+        # totals of one pharmacy or patient over a range of days or months
+        db.Index("ix_transaction_rollups_uuid_bucket", "period", "dimension",
+                 "uuid", "bucket"), )
+    period = db.Column(db.String(5), primary_key=True)
+    dimension = db.Column(db.String(10), primary_key=True)
+    bucket = db.Column(db.String(10), primary_key=True)
+    uuid = db.Column(db.String(256), primary_key=True)
+    count = db.Column(db.Integer, nullable=False)
     amount = db.Column(db.Float, nullable=False)
-    timestamp = db.Column(db.DateTime, nullable=False)
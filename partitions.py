@@ -0,0 +1,211 @@
+import re
+from datetime import datetime
+
+from sqlalchemy import (CheckConstraint, Column, ForeignKey, Index, MetaData,
+                        Table, and_, func, inspect, select, union_all)
+from sqlalchemy.orm import aliased
+
+from database import table_exists
+from models import Transaction
+from rollups import apply_rollup_deltas, rollup_deltas
+from versions import bump_data_versions
+
+# View of the transactions table followed by its monthly partitions, created
+# by flask upgrade-db. Transaction queries read from it once it exists.
+PARTITIONED_VIEW = "transactions_partitioned"
+
+PARTITION_NAME = re.compile(r"transactions_(\d{4})_(\d{2})$")
+
+
+def add_months(month, count):
+    index = month.year * 12 + month.month - 1 + count
+    return datetime(index // 12, index % 12 + 1, 1)
+
+
+def partition_name(month):
+    return f"transactions_{month:%Y_%m}"
+
+
+def transaction_table_columns():
+    """
+    Function used to copy the columns of the transactions table, foreign keys included.
+    """
+
+    return [
+        Column(column.name,
+               column.type,
+               *[ForeignKey(key.column) for key in column.foreign_keys],
+               primary_key=column.primary_key,
+               nullable=column.nullable)
+        for column in Transaction.__table__.columns
+    ]
+
+
+partitioned_view = Table(PARTITIONED_VIEW, MetaData(),
+                         *transaction_table_columns())
+
+# Transaction mapped to the view, with the same columns and relationships.
+PartitionedTransaction = aliased(Transaction,
+                                 partitioned_view,
+                                 adapt_on_names=True)
+
+
+def transaction_source(engine):
+    """
+    Function used to get the entity transaction queries select from: the partitioned view once flask upgrade-db
+    created it, otherwise the transactions table.
+    """
+
+    if table_exists(engine, PARTITIONED_VIEW):
+        return PartitionedTransaction
+    return Transaction
+
+
+def partition_table(month):
+    """
+    Function used to build the table holding the transactions of a month.
+
+    Its check constraint lets postgres skip it in queries whose timestamp range excludes the month (with the default
+    constraint_exclusion = partition), and its timestamp index makes that a single index lookup on sqlite.
+
+    Args:
+        month: datetime of the first day of the month.
+
+    Returns:
+        sqlalchemy.Table with the columns of the transactions table.
+    """
+
+    name = partition_name(month)
+    table = Table(
+        name, MetaData(), *transaction_table_columns(),
+        CheckConstraint(
+            f"\"timestamp\" >= '{month:%Y-%m-%d}' AND "
+            f"\"timestamp\" < '{add_months(month, 1):%Y-%m-%d}'",
+            name=f"ck_{name}_month"))
+    Index(f"ix_{name}_timestamp", table.c.timestamp)
+    Index(f"ix_{name}_patient_uuid_timestamp", table.c.patient_uuid,
+          table.c.timestamp)
+    Index(f"ix_{name}_pharmacy_uuid_timestamp", table.c.pharmacy_uuid,
+          table.c.timestamp)
+    return table
+
+
+def partition_months(conn):
+    """
+    Function used to list the months that have a partition.
+
+    Returns:
+        (list) sorted datetimes of the first day of each month.
+    """
+
+    months = []
+    for name in inspect(conn).get_table_names():
+        match = PARTITION_NAME.match(name)
+        if match:
+            months.append(datetime(int(match[1]), int(match[2]), 1))
+    return sorted(months)
+
+
+def create_partitioned_view(conn, months=None):
+    """
+    Function used to create, or replace, the view of the transactions table and its partitions.
+
+    The view has no condition of its own, so the filters of a query are pushed down into each table and answered by
+    its indexes.
+
+    Args:
+        conn: database connection.
+        months: months of the partitions in the view, all the existing ones by default.
+    """
+
+    if months is None:
+        months = partition_months(conn)
+    tables = [Transaction.__table__] + [partition_table(m) for m in months]
+    view = union_all(*[select(*table.c) for table in tables])
+    conn.exec_driver_sql(f"DROP VIEW IF EXISTS {PARTITIONED_VIEW}")
+    conn.exec_driver_sql(f"CREATE VIEW {PARTITIONED_VIEW} AS "
+                         f"{view.compile(dialect=conn.dialect)}")
+
+
+def partition_transactions(engine, before):
+    """
+    Function used to move the transactions older than a month from the transactions table into monthly partitions.
+
+    Each month is copied, deleted from the transactions table and added to the view in its own database
+    transaction, so readers always see every transaction exactly once and the transactions table is only locked for
+    one month at a time. Transactions written later for a partitioned month are moved by the next run.
+
+    Args:
+        engine: engine of the database, the partitioned view must exist.
+        before: datetime of the first day of the oldest month kept in the transactions table.
+
+    Returns:
+        (list) month and number of transactions moved, for each month with transactions.
+    """
+
+    hot = Transaction.__table__
+    with engine.connect() as conn:
+        oldest = conn.execute(
+            select(func.min(
+                hot.c.timestamp)).where(hot.c.timestamp < before)).scalar()
+
+    moved = []
+    # first day of the month of the oldest transaction
+    month = add_months(oldest, 0) if oldest is not None else before
+    while month < before:
+        in_month = and_(hot.c.timestamp >= month,
+                        hot.c.timestamp < add_months(month, 1))
+        with engine.begin() as conn:
+            count = conn.execute(
+                select(
+                    func.count()).select_from(hot).where(in_month)).scalar()
+            if count:
+                table = partition_table(month)
+                table.create(conn, checkfirst=True)
+                conn.execute(table.insert().from_select(
+                    list(hot.c.keys()),
+                    select(*hot.c).where(in_month)))
+                conn.execute(hot.delete().where(in_month))
+                create_partitioned_view(conn)
+                moved.append((month, count))
+        month = add_months(month, 1)
+    return moved
+
+
+def archive_partition(engine, month, archive, batch_size):
+    """
+    Function used to move a partition out of the database into another one, e.g. a standalone SQLite file.
+
+    The rows are copied reading only the partition, then the partition is removed from the view and dropped in a
+    short transaction that never touches the transactions table. Archived transactions are no longer served, nor
+    counted in the rollup totals.
+
+    Args:
+        engine: engine of the database.
+        month: datetime of the first day of the month of the partition.
+        archive: engine of the database the partition is copied to.
+        batch_size: rows inserted at a time.
+
+    Returns:
+        (int) number of transactions archived.
+    """
+
+    table = partition_table(month)
+    table.create(archive)
+    count = 0
+    deltas = {}
+    with engine.connect() as conn, archive.begin() as archive_conn:
+        result = conn.execution_options(stream_results=True).execute(
+            select(table))
+        for rows in result.mappings().partitions(batch_size):
+            archive_conn.execute(table.insert(), [dict(row) for row in rows])
+            rollup_deltas(rows, -1, deltas)
+            count += len(rows)
+
+    with engine.begin() as conn:
+        create_partitioned_view(
+            conn, [m for m in partition_months(conn) if m != month])
+        table.drop(conn)
+        apply_rollup_deltas(conn, deltas)
+        bump_data_versions(conn, ["transactions"])
+    return count
@@ -0,0 +1,161 @@
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from metrics import Counter, Gauge, Histogram
+
+# Buckets of the bcrypt durations, 12 rounds take about a quarter of a second.
+HASH_BUCKETS = (.05, .1, .2, .3, .5, .75, 1, 2, 5)
+
+
+class PasswordPoolBusy(Exception):
+    """
+    Raised when every process of the password pool is busy and its queue is full.
+    """
+
+
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start
+
+
+class PasswordPool:
+    """
+    Pool of processes hashing and checking passwords with bcrypt, so a burst of logins doesn't hold the threads
+    serving other requests.
+
+    At most max_pending operations are in the pool at once, one per process plus queue_size waiting for a free
+    process. Beyond that submit raises PasswordPoolBusy right away, so clients get a fast 503 instead of waiting
+    behind the burst.
+
+    Args:
+        bcrypt: Flask-Bcrypt extension, the processes hash with its settings.
+        processes: number of processes, 0 runs the operations in the calling thread.
+        queue_size: number of operations that can wait for a free process.
+        registry: metrics.MetricsRegistry the pool metrics are added to.
+    """
+
+    def __init__(self, bcrypt, processes, queue_size, registry):
+        self.bcrypt = bcrypt
+        self.processes = processes
+        self.max_pending = max(processes, 1) + queue_size
+        self.pending = 0
+        self._executor = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+        self.hash_seconds = registry.add(
+            Histogram("password_hash_seconds",
+                      "Time spent hashing a password with bcrypt.",
+                      ("operation", ), HASH_BUCKETS))
+        self.rejected = registry.add(
+            Counter("password_pool_rejected_total",
+                    "Password operations refused because the pool was full."))
+        registry.add(
+            Gauge("password_pool_pending",
+                  "Password operations running or waiting for a process.",
+                  lambda: self.pending))
+        registry.add(
+            Gauge("password_pool_queued",
+                  "Password operations waiting for a free process.",
+                  lambda: max(self.pending - max(self.processes, 1), 0)))
+
+    def executor(self):
+        # created on first use in each process, since gunicorn forks workers
+        # after the app is imported, and again when one of its processes died
+        with self._lock:
+            if (self._executor is not None and self._pid == os.getpid()
+                    and self._executor._broken):
+                self._executor.shutdown(wait=False)
+                self._executor = None
+            if self._executor is None or self._pid != os.getpid():
+                self._executor = ProcessPoolExecutor(
+                    self.processes,
+                    mp_context=multiprocessing.get_context("spawn"))
+                self._pid = os.getpid()
+            return self._executor
+
+    def submit(self, operation, *args):
+        """
+        Function used to run a method of the bcrypt extension in the pool.
+
+        If a process of the pool dies, e.g. killed for lack of memory, the pool is replaced and the operation runs
+        once more in the new one.
+
+        Args:
+            operation: 'check_password_hash' or 'generate_password_hash'.
+            args: arguments of the method.
+
+        Returns:
+            concurrent.futures.Future of the result.
+
+        Raises:
+            PasswordPoolBusy: max_pending operations are already in the pool.
+        """
+
+        with self._lock:
+            if self.pending >= self.max_pending:
+                self.rejected.inc()
+                raise PasswordPoolBusy()
+            self.pending += 1
+
+        result = Future()
+
+        def done(future, retry=False):
+            if retry and isinstance(future.exception(), BrokenProcessPool):
+                try:
+                    start(retry=False)
+                    return
+                except Exception as error:
+                    future = Future()
+                    future.set_exception(error)
+            with self._lock:
+                self.pending -= 1
+            if future.exception() is not None:
+                result.set_exception(future.exception())
+                return
+            value, seconds = future.result()
+            self.hash_seconds.observe(seconds, operation)
+            result.set_result(value)
+
+        method = getattr(self.bcrypt, operation)
+
+        def start(retry):
+            try:
+                future = self.executor().submit(timed, method, *args)
+            except BrokenProcessPool:
+                if not retry:
+                    raise
+                return start(retry=False)
+            future.add_done_callback(lambda future: done(future, retry))
+
+        if self.processes == 0:
+            future = Future()
+            try:
+                future.set_result(timed(method, *args))
+            except Exception as error:
+                future.set_exception(error)
+            done(future)
+        else:
+            try:
+                start(retry=True)
+            except Exception:
+                with self._lock:
+                    self.pending -= 1
+                raise
+        return result
+
+    def check(self, pw_hash, password):
+        return self.submit("check_password_hash", pw_hash, password).result()
+
+    def generate(self, password):
+        return self.submit("generate_password_hash", password).result()
+
+    def shutdown(self):
+        if self._executor is not None and self._pid == os.getpid():
+            self._executor.shutdown()
+        self._executor = None
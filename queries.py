@@ -0,0 +1,708 @@
+import base64
+import binascii
+import json
+import re
+from datetime import datetime, timedelta
+
+from flask import current_app
+from sqlalchemy import and_, func, or_
+from sqlalchemy.orm import Query
+
+from models import Patient, Pharmacy, TransactionRollup, db
+from partitions import add_months, transaction_source
+from rollups import ROLLUP_DIMENSIONS, ROLLUP_PERIODS
+from search import search_filter, transaction_search_filter
+
+MATCH_MODES = ("contains", "exact", "prefix")
+
+# strftime formats of the time buckets /transactions/summary can group by
+TIME_BUCKETS = {"day": "%Y-%m-%d", "month": "%Y-%m"}
+
+# strftime formats of the dates sent by the list endpoints
+DATE_FORMAT = '%m/%d/%Y'
+DATETIME_FORMAT = '%m/%d/%Y %H:%M:%S'
+
+# 'timestamp' values that can only match the date part of a timestamp.
+DATE_PREFIX = re.compile(r"\d{4}-\d{2}(-\d{2})?$")
+
+
+class QueryError(ValueError):
+    """
+    Raised when the query string of a request can't be turned into a query, the message is sent back to the client.
+    """
+
+
+def text_filter(column, args, name):
+    """
+    Function used to build the filter of a string parameter.
+
+    The parameter '<name>_match' chooses how the value is compared: 'contains' (default) matches it anywhere in the
+    column, 'exact' matches the whole column and 'prefix' matches its start. Only 'exact' and 'prefix' can be answered
+    by an index, and unlike 'contains' they are case sensitive.
+
+    Args:
+        column: column to filter.
+        args: request query string parameters.
+        name: name of the parameter with the value to match.
+
+    Returns:
+        SQL expression of the filter.
+    """
+
+    term = args[name]
+    mode = args.get(name + "_match", "contains")
+    if mode == "contains":
+        return column.like(f'%{term}%')
+    if mode == "exact":
+        return column == term
+    if mode == "prefix":
+        # a range instead of LIKE 'term%' so sqlite can use the index
+        if not term or term[-1] == chr(0x10ffff):
+            return column >= term
+        return and_(column >= term,
+                    column < term[:-1] + chr(ord(term[-1]) + 1))
+    raise QueryError(f"{name}_match must be one of {', '.join(MATCH_MODES)}")
+
+
+def parse_date(args, name):
+    """
+    Function used to read a date or datetime parameter.
+
+    Args:
+        args: request query string parameters.
+        name: name of the parameter.
+
+    Returns:
+        (datetime) parsed value.
+        (bool) True if the value had only the date part.
+    """
+
+    value = args[name]
+    try:
+        return datetime.fromisoformat(value), len(value) == len("YYYY-MM-DD")
+    except ValueError:
+        raise QueryError(
+            f"{name} must be in the format year-month-day or year-month-dayThour:minute:second"
+        )
+
+
+def date_range_filters(column, args, name):
+    """
+    Function used to build the filters of the '<name>_from' and '<name>_to' parameters, both inclusive.
+
+    Values are compared as datetimes, so the column's index can be used. A '<name>_to' with only the date part
+    includes the whole day.
+
+    Args:
+        column: DateTime column to filter.
+        args: request query string parameters.
+        name: common prefix of the parameters.
+
+    Returns:
+        (list) SQL expressions of the filters.
+    """
+
+    filters = []
+    if name + "_from" in args:
+        start, _ = parse_date(args, name + "_from")
+        filters.append(column >= start)
+    if name + "_to" in args:
+        end, date_only = parse_date(args, name + "_to")
+        if date_only:
+            filters.append(column < end + timedelta(days=1))
+        else:
+            filters.append(column <= end)
+    return filters
+
+
+def timestamp_filter(column, value):
+    """
+    Function used to build the filter of the 'timestamp' parameter, matching the value anywhere in the timestamp.
+
+    A year and month, or a date, can only match the start of a timestamp, so it is compared as a range that the
+    timestamp indexes and the partitions can answer, instead of a LIKE scanning every row.
+
+    Args:
+        column: DateTime column to filter.
+        value: value of the parameter.
+
+    Returns:
+        SQL expression of the filter.
+    """
+
+    if DATE_PREFIX.match(value):
+        try:
+            start = datetime.fromisoformat(value if len(value) > 7 else value +
+                                           "-01")
+        except ValueError:
+            return column.like(f'%{value}%')
+        if len(value) > 7:
+            return and_(column >= start, column < start + timedelta(days=1))
+        return and_(column >= start, column < add_months(start, 1))
+    return column.like(f'%{value}%')
+
+
+def patient_filters(args, prefix=""):
+    """
+    Function used to build the filters of the patient parameters.
+
+    Args:
+        args: request query string parameters.
+        prefix: prefix of the parameter names, e.g. 'patient_' for /transactions.
+
+    Returns:
+        (list) SQL expressions of the filters.
+    """
+
+    filters = []
+    for name, column in (("first_name", Patient.first_name),
+                         ("last_name", Patient.last_name)):
+        if prefix + name in args:
+            filters.append(text_filter(column, args, prefix + name))
+    if prefix + "date_of_birth" in args:
+        arg = args[prefix + "date_of_birth"]
+        filters.append(Patient.date_of_birth.like(f'%{arg}%'))
+    filters.extend(
+        date_range_filters(Patient.date_of_birth, args, prefix + "dob"))
+    if not prefix and "q" in args:
+        filters.append(search_filter(Patient, args["q"]))
+    return filters
+
+
+def pharmacy_filters(args, prefix=""):
+    """
+    Function used to build the filters of the pharmacy parameters.
+
+    Args:
+        args: request query string parameters.
+        prefix: prefix of the parameter names, e.g. 'pharmacy_' for /transactions.
+
+    Returns:
+        (list) SQL expressions of the filters.
+    """
+
+    filters = []
+    for name, column in (("name", Pharmacy.name), ("city", Pharmacy.city)):
+        if prefix + name in args:
+            filters.append(text_filter(column, args, prefix + name))
+    if not prefix and "q" in args:
+        filters.append(search_filter(Pharmacy, args["q"]))
+    return filters
+
+
+def own_transaction_filters(args):
+    """
+    Function used to build the filters of the transaction parameters that don't need its patient or pharmacy joined.
+
+    Args:
+        args: request query string parameters.
+
+    Returns:
+        (list) SQL expressions of the filters.
+    """
+
+    transaction = transaction_source(db.engine)
+    filters = []
+    if "amount" in args:
+        filters.append(transaction.amount == str(args["amount"]))
+    if "timestamp" in args:
+        filters.append(
+            timestamp_filter(transaction.timestamp, args["timestamp"]))
+    filters.extend(date_range_filters(transaction.timestamp, args,
+                                      "timestamp"))
+    if "q" in args:
+        filters.append(transaction_search_filter(transaction, args["q"]))
+    return filters
+
+
+def transaction_filters(args):
+    """
+    Function used to build the filters of the transaction parameters, including the ones on its patient and pharmacy.
+
+    Args:
+        args: request query string parameters.
+
+    Returns:
+        (list) SQL expressions of the filters.
+    """
+
+    return (patient_filters(args, "patient_") +
+            pharmacy_filters(args, "pharmacy_") +
+            own_transaction_filters(args))
+
+
+def format_datetime(column, fmt):
+    """
+    Function used to build the expression formatting a DateTime column with a strftime format in the database.
+    """
+
+    if db.engine.dialect.name == "postgresql":
+        for code, pattern in (("%Y", "YYYY"), ("%m", "MM"), ("%d", "DD"),
+                              ("%H", "HH24"), ("%M", "MI"), ("%S", "SS")):
+            fmt = fmt.replace(code, pattern)
+        return func.to_char(column, fmt)
+    return func.strftime(fmt, column)
+
+
+def patient_columns(format_dates=True):
+    """
+    Function used to get the columns selected for a patient, in the order of patient_fields.
+
+    Dates are formatted by the database, so rows are sent as they are read, unless format_dates is False.
+    """
+
+    date_of_birth = Patient.date_of_birth
+    if format_dates:
+        date_of_birth = format_datetime(date_of_birth, DATE_FORMAT)
+    return (Patient.uuid, Patient.first_name, Patient.last_name, date_of_birth)
+
+
+def pharmacy_columns():
+    """
+    Function used to get the columns selected for a pharmacy, in the order of pharmacy_fields.
+    """
+
+    return (Pharmacy.uuid, Pharmacy.name, Pharmacy.city)
+
+
+def transaction_columns(format_dates=True):
+    """
+    Function used to get the columns exported for a transaction with its patient and pharmacy, in the order
+    export.export_transactions reads them.
+    """
+
+    transaction = transaction_source(db.engine)
+    timestamp = transaction.timestamp
+    if format_dates:
+        timestamp = format_datetime(timestamp, DATETIME_FORMAT)
+    return (transaction.uuid, transaction.amount, timestamp,
+            *patient_columns(format_dates), *pharmacy_columns())
+
+
+def patient_fields():
+    """
+    Function used to get the fields of a patient that can be selected, with their columns.
+    """
+
+    return dict(
+        zip(("id", "first_name", "last_name", "date_of_birth"),
+            patient_columns()))
+
+
+def pharmacy_fields():
+    """
+    Function used to get the fields of a pharmacy that can be selected, with their columns.
+    """
+
+    return dict(zip(("id", "name", "city"), pharmacy_columns()))
+
+
+def transaction_fields():
+    """
+    Function used to get the fields of a transaction that can be selected, with their columns. The patient and
+    pharmacy fields are nested dicts.
+    """
+
+    transaction = transaction_source(db.engine)
+    return {
+        "id": transaction.uuid,
+        "amount": transaction.amount,
+        "timestamp": format_datetime(transaction.timestamp, DATETIME_FORMAT),
+        "patient": patient_fields(),
+        "pharmacy": pharmacy_fields(),
+    }
+
+
+def select_fields(available, args):
+    """
+    Function used to read the 'fields' parameter of a request.
+
+    'fields' is a comma separated list of field names, e.g. 'id,amount,patient.first_name'. A nested object can be
+    selected whole ('patient') or field by field ('patient.first_name').
+
+    Args:
+        available: dict of the fields that can be selected, see transaction_fields.
+        args: request query string parameters.
+
+    Returns:
+        (dict) the selected part of available, all of it if the parameter is missing.
+    """
+
+    if "fields" not in args:
+        return available
+
+    selected = {}
+    for name in args["fields"].split(","):
+        name = name.strip()
+        parent, _, child = name.partition(".")
+        value = available.get(parent)
+        if value is None or (child and (not isinstance(value, dict)
+                                        or child not in value)):
+            raise QueryError(
+                f"unknown field {name!r}, fields are {', '.join(field_names(available))}"
+            )
+        if not child:
+            selected[parent] = value
+        elif selected.get(parent) is not value:
+            selected.setdefault(parent, {})[child] = value[child]
+    return selected
+
+
+def field_names(fields, prefix=""):
+    names = []
+    for name, value in fields.items():
+        if isinstance(value, dict):
+            names.extend(field_names(value, prefix + name + "."))
+        else:
+            names.append(prefix + name)
+    return names
+
+
+def field_columns(fields):
+    """
+    Function used to get the columns of the selected fields, in the order serializers.fields_serializer reads them.
+    """
+
+    columns = []
+    for value in fields.values():
+        if isinstance(value, dict):
+            columns.extend(field_columns(value))
+        else:
+            columns.append(value)
+    return columns
+
+
+def transaction_query(fields, args):
+    """
+    Function used to build the query of /transactions selecting only the columns of fields.
+
+    Patients and pharmacies are joined only when a selected field or a filter needs them. Transactions are sorted by
+    their patient's first name and id, or just by id when patients aren't joined.
+
+    Args:
+        fields: selected fields, see select_fields.
+        args: request query string parameters.
+
+    Returns:
+        Query, without a session, whose rows have the columns of fields followed by the sort keys.
+        (tuple) columns to sort by.
+    """
+
+    transaction = transaction_source(db.engine)
+    patient_where = patient_filters(args, "patient_")
+    pharmacy_where = pharmacy_filters(args, "pharmacy_")
+    join_patient = bool(patient_where) or "patient" in fields
+    keys = (Patient.first_name,
+            transaction.uuid) if join_patient else (transaction.uuid, )
+
+    query = Query([*field_columns(fields), *keys]).select_from(transaction)
+    if join_patient:
+        query = query.join(Patient)
+    if pharmacy_where or "pharmacy" in fields:
+        query = query.join(Pharmacy)
+    return query.filter(*patient_where, *pharmacy_where,
+                        *own_transaction_filters(args)), keys
+
+
+def summary_groups(name):
+    """
+    Function used to get the labeled columns of a /transactions/summary group.
+
+    Args:
+        name: one of 'pharmacy', 'city', 'patient', 'day' or 'month'.
+
+    Returns:
+        (list) (label, column expression) pairs.
+    """
+
+    if name == "pharmacy":
+        return [("pharmacy_id", Pharmacy.uuid),
+                ("pharmacy_name", Pharmacy.name)]
+    if name == "city":
+        return [("city", Pharmacy.city)]
+    if name == "patient":
+        return [("patient_id", Patient.uuid),
+                ("patient_first_name", Patient.first_name),
+                ("patient_last_name", Patient.last_name)]
+    if name in TIME_BUCKETS:
+        return [(name,
+                 format_datetime(
+                     transaction_source(db.engine).timestamp,
+                     TIME_BUCKETS[name]))]
+    raise QueryError(
+        "group_by must be a comma separated list of pharmacy, city, patient, day or month"
+    )
+
+
+def transaction_summary(args):
+    """
+    Function used to build the query aggregating the transaction amounts for /transactions/summary.
+
+    Accepts the same filters as /transactions. The parameter 'group_by' is a comma separated list of groups, see
+    summary_groups, without it a single row with the totals is returned.
+
+    Args:
+        args: request query string parameters.
+
+    Returns:
+        Query with one row per group.
+        (list) labels of the columns of the rows.
+    """
+
+    groups = []
+    for name in args.get("group_by", "").split(","):
+        if name:
+            groups.extend(summary_groups(name))
+
+    transaction = transaction_source(db.engine)
+    keys = [column.label(label) for label, column in groups]
+    aggregates = [
+        func.count(transaction.uuid).label("count"),
+        func.sum(transaction.amount).label("sum"),
+        func.avg(transaction.amount).label("avg"),
+        func.min(transaction.amount).label("min"),
+        func.max(transaction.amount).label("max"),
+    ]
+    query = Query([
+        *keys, *aggregates
+    ]).select_from(transaction).join(Patient).join(Pharmacy).filter(
+        *transaction_filters(args))
+    if keys:
+        query = query.group_by(*keys).order_by(*keys)
+
+    return query, [label for label, _ in groups
+                   ] + [aggregate.name for aggregate in aggregates]
+
+
+def rollup_query(args):
+    """
+    Function used to build the query of /transactions/rollups, reading the totals of the rollup table.
+
+    The parameter 'period' is 'day' (default) or 'month' and 'group_by' is 'pharmacy' (default) or 'patient'. 'id'
+    keeps the totals of a single pharmacy or patient, and 'timestamp_from' and 'timestamp_to' the ones of the days
+    or months in a range, both inclusive.
+
+    Args:
+        args: request query string parameters.
+
+    Returns:
+        Query with one row per day or month and pharmacy or patient.
+        (list) labels of the columns of the rows.
+    """
+
+    period = args.get("period", "day")
+    if period not in ROLLUP_PERIODS:
+        raise QueryError("period must be day or month")
+    dimension = args.get("group_by", "pharmacy")
+    if dimension not in ROLLUP_DIMENSIONS:
+        raise QueryError("group_by must be pharmacy or patient")
+
+    rollup = TransactionRollup
+    query = Query([rollup.bucket, rollup.uuid, rollup.count,
+                   rollup.amount]).filter(rollup.period == period,
+                                          rollup.dimension == dimension)
+    if "id" in args:
+        query = query.filter(rollup.uuid == args["id"])
+    fmt = ROLLUP_PERIODS[period]
+    if "timestamp_from" in args:
+        start, _ = parse_date(args, "timestamp_from")
+        query = query.filter(rollup.bucket >= start.strftime(fmt))
+    if "timestamp_to" in args:
+        end, _ = parse_date(args, "timestamp_to")
+        query = query.filter(rollup.bucket <= end.strftime(fmt))
+    return query.order_by(rollup.bucket, rollup.uuid), [
+        period, dimension + "_id", "count", "sum"
+    ]
+
+
+def lookup_ids(args):
+    """
+    Function used to read the 'ids' parameter of a request, a comma separated list of at most PAGE_SIZE_MAX ids.
+
+    Args:
+        args: request query string parameters.
+
+    Returns:
+        (list) ids in the order they were sent, without duplicates.
+    """
+
+    if len(args) > 1:
+        raise QueryError("ids can't be combined with other parameters")
+    ids = list(
+        dict.fromkeys(uuid.strip() for uuid in args["ids"].split(",")
+                      if uuid.strip()))
+    max_size = current_app.config['PAGE_SIZE_MAX']
+    if not 1 <= len(ids) <= max_size:
+        raise QueryError(f"ids must have between 1 and {max_size} ids")
+    return ids
+
+
+def lookup_query(table_name, ids):
+    """
+    Function used to build the query reading patients, pharmacies or transactions by primary key.
+
+    Args:
+        table_name: 'patients', 'pharmacies' or 'transactions'.
+        ids: ids of the rows.
+
+    Returns:
+        Query whose rows have every field of the table, in the order serializers.patient_to_dict, pharmacy_to_dict
+        or transaction_to_dict read them, id first.
+    """
+
+    if table_name == "patients":
+        return Query(patient_columns()).filter(Patient.uuid.in_(ids))
+    if table_name == "pharmacies":
+        return Query(pharmacy_columns()).filter(Pharmacy.uuid.in_(ids))
+
+    transaction = transaction_source(db.engine)
+    return Query(transaction_columns()).select_from(transaction).join(
+        Patient).join(Pharmacy).filter(transaction.uuid.in_(ids))
+
+
+def encode_cursor(values):
+    """
+    Function used to turn the sort key of the last row of a page into an opaque cursor.
+
+    Args:
+        values: sort key values of the row, in the same order as the keys used for sorting.
+
+    Returns:
+        (str) url safe cursor string.
+    """
+
+    data = json.dumps(list(values), separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(data).decode('ascii')
+
+
+def decode_cursor(cursor, size):
+    """
+    Function used to read back the sort key stored in a cursor made by encode_cursor.
+
+    Args:
+        cursor: cursor string sent by the client.
+        size: number of sort keys the cursor must have.
+
+    Returns:
+        (list) sort key values.
+    """
+
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    except (binascii.Error, UnicodeError, ValueError):
+        raise QueryError("invalid cursor")
+
+    if not isinstance(values, list) or len(values) != size:
+        raise QueryError("invalid cursor")
+    return values
+
+
+def after_cursor(keys, values):
+    """
+    Function used to build the filter selecting the rows that come after a sort key.
+
+    Args:
+        keys: columns the query is sorted by, ascending.
+        values: sort key of the last row already seen.
+
+    Returns:
+        SQL expression equivalent to (keys) > (values).
+    """
+
+    clauses = []
+    for i, (key, value) in enumerate(zip(keys, values)):
+        equal = [k == v for k, v in zip(keys[:i], values[:i])]
+        clauses.append(and_(*equal, key > value))
+    return or_(*clauses)
+
+
+def page_size(args, streamed=False):
+    """
+    Function used to read the 'limit' parameter of a request.
+
+    Without it, every row is sent unless PAGE_SIZE_DEFAULT is set: then a response that isn't streamed has at most
+    that many rows. A cursor without a limit gets pages of PAGE_SIZE_DEFAULT rows, or PAGE_SIZE_MAX when it isn't
+    set.
+
+    Args:
+        args: request query string parameters.
+        streamed: True if the rows are streamed, see serializers.stream_format.
+
+    Returns:
+        (int) number of rows in a page, None if the response isn't paginated.
+    """
+
+    if "limit" not in args:
+        default = current_app.config['PAGE_SIZE_DEFAULT']
+        if "cursor" in args:
+            return default or current_app.config['PAGE_SIZE_MAX']
+        if streamed or not default:
+            return None
+        return default
+
+    max_size = current_app.config['PAGE_SIZE_MAX']
+    try:
+        limit = int(args["limit"])
+    except ValueError:
+        limit = 0
+    if not 1 <= limit <= max_size:
+        raise QueryError(f"limit must be between 1 and {max_size}")
+    return limit
+
+
+def paginate(query, keys, key_of, args, batch_size=None):
+    """
+    Function used to sort a query and, if requested, return only one page of it.
+
+    Pages are selected by keyset rather than OFFSET: the cursor holds the sort key of the last row of the previous
+    page, so any page costs the same to fetch no matter how deep it is. The last key must be unique to keep the
+    order stable.
+
+    Args:
+        query: query to paginate.
+        keys: columns to sort by.
+        key_of: function returning the sort key values of a row of the query.
+        args: request query string parameters, see page_size.
+        batch_size: if set and the query isn't paginated the rows are fetched lazily, batch_size at a time.
+
+    Returns:
+        (list) rows of the page, or an iterable over all rows if batch_size is set.
+        (str) cursor for the next page or None if this is the last one.
+    """
+
+    query, limit = page_query(query, keys, args, batch_size is not None)
+    if limit is None:
+        if batch_size:
+            return query.yield_per(batch_size), None
+        return query.all(), None
+    return page_rows(query.all(), limit, key_of)
+
+
+def page_query(query, keys, args, streamed=False):
+    """
+    Function used to sort a query and restrict it to the requested page, see paginate and page_size.
+
+    Returns:
+        Query sorted by keys, selecting one row more than the page size if paginated.
+        (int) page size, None if the query isn't paginated.
+    """
+
+    query = query.order_by(*keys)
+    limit = page_size(args, streamed)
+    if limit is None:
+        return query, None
+
+    if "cursor" in args:
+        values = decode_cursor(args["cursor"], len(keys))
+        query = query.filter(after_cursor(keys, values))
+    return query.limit(limit + 1), limit
+
+
+def page_rows(rows, limit, key_of):
+    """
+    Function used to split the rows read by a page_query into the page and the cursor of the next one.
+    """
+
+    if len(rows) > limit:
+        return rows[:limit], encode_cursor(key_of(rows[limit - 1]))
+    return rows, None
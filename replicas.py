@@ -0,0 +1,174 @@
+import itertools
+import threading
+import time
+
+from sqlalchemy import create_engine
+from sqlalchemy.exc import SQLAlchemyError
+
+from database import engine_options
+from metrics import Gauge
+from versions import (VERSIONED_TABLES, data_versions_statement,
+                      versions_enabled, versions_of)
+
+
+def read_versions(engine):
+    """
+    Function used to read the data versions of every versioned table of a database, see versions.data_versions.
+    """
+
+    with engine.connect() as conn:
+        return versions_of(
+            VERSIONED_TABLES,
+            conn.execute(data_versions_statement(VERSIONED_TABLES)))
+
+
+class Replica:
+    """
+    Read replica of the primary database and the result of its last health check.
+
+    Args:
+        url: SQLAlchemy url of the replica.
+        engine: engine connected to the replica.
+    """
+
+    def __init__(self, url, engine):
+        self.url = url
+        self.engine = engine
+        # start time of the last check that found every write of the primary
+        # on the replica
+        self.synced_at = None
+        self.error = None
+
+    def fresh(self, now, max_lag):
+        return (self.error is None and self.synced_at is not None
+                and now - self.synced_at <= max_lag)
+
+
+class ReplicaSet:
+    """
+    Read replicas the read endpoints are balanced across, round robin.
+
+    A replica is only used while it is known to lag the primary by at most max_lag seconds. Every check_interval
+    seconds one request checks them all: it reads the data versions of the primary, then of each replica, and a
+    replica whose versions are all at least the primary's had every write committed before the check started.
+    Replicas that can't be read or are behind are skipped, and the reads go to the primary when none is fresh.
+    Without a data_versions table on the primary the lag can't be measured and no replica is used.
+
+    Args:
+        engines: dict of replica urls to their engines.
+        max_lag: staleness bound, in seconds.
+        check_interval: seconds between two health checks, should be well below max_lag.
+        registry: metrics.MetricsRegistry the replica metrics are added to.
+        timer: function returning the current time in seconds.
+    """
+
+    def __init__(self,
+                 engines,
+                 max_lag,
+                 check_interval,
+                 registry,
+                 timer=time.monotonic):
+        self.replicas = [
+            Replica(url, engine) for url, engine in engines.items()
+        ]
+        self.max_lag = max_lag
+        self.check_interval = check_interval
+        self.timer = timer
+        self.checked_at = None
+        self._counter = itertools.count()
+        self._check_lock = threading.Lock()
+
+        registry.add(
+            Gauge("read_replicas_fresh",
+                  "Read replicas within the staleness bound.",
+                  lambda: len(self.fresh_replicas(self.timer()))))
+
+    def fresh_replicas(self, now):
+        return [
+            replica for replica in self.replicas
+            if replica.fresh(now, self.max_lag)
+        ]
+
+    def check(self, primary):
+        """
+        Function used to check the health and the staleness of every replica.
+
+        Args:
+            primary: engine of the primary database.
+        """
+
+        started = self.timer()
+        self.checked_at = started
+        if not versions_enabled(primary):
+            return
+        expected = read_versions(primary)
+
+        for replica in self.replicas:
+            try:
+                versions = read_versions(replica.engine)
+            except SQLAlchemyError as error:
+                replica.error = str(error)
+                continue
+            # a different epoch is another database, see versions.EPOCH
+            if versions[0] == expected[0] and all(
+                    version >= primary_version
+                    for version, primary_version in zip(
+                        versions[1:], expected[1:])):
+                replica.synced_at = started
+                replica.error = None
+            else:
+                replica.error = "behind the primary"
+
+    def choose(self, primary):
+        """
+        Function used to pick the replica serving the reads of a request, checking the replicas first when the
+        last check is older than check_interval.
+
+        Args:
+            primary: engine of the primary database.
+
+        Returns:
+            Engine of a fresh replica, or None to read from the primary.
+        """
+
+        if self.checked_at is None or self.timer(
+        ) - self.checked_at >= self.check_interval:
+            # the other threads keep using the last results meanwhile
+            if self._check_lock.acquire(blocking=False):
+                try:
+                    self.check(primary)
+                finally:
+                    self._check_lock.release()
+
+        fresh = self.fresh_replicas(self.timer())
+        if not fresh:
+            return None
+        return fresh[next(self._counter) % len(fresh)].engine
+
+
+def create_replica_set(config, registry):
+    """
+    Function used to create the read replicas listed in READ_REPLICA_URLS, each with the engine options of its
+    backend, see database.engine_options.
+
+    Args:
+        config: app config.
+        registry: metrics.MetricsRegistry the replica metrics are added to.
+
+    Returns:
+        The ReplicaSet, or None if no replica is configured.
+    """
+
+    urls = [
+        url.strip() for url in config['READ_REPLICA_URLS'].split(",")
+        if url.strip()
+    ]
+    if not urls:
+        return None
+    engines = {
+        url: create_engine(
+            url, **engine_options(dict(config, SQLALCHEMY_DATABASE_URI=url)))
+        for url in urls
+    }
+    return ReplicaSet(engines, config['READ_REPLICA_MAX_LAG'],
+                      config['READ_REPLICA_CHECK_INTERVAL'], registry)
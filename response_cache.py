@@ -0,0 +1,200 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+def cache_key(path, args, versions, encoding=None):
+    """
+    Function used to build the key of a response in the cache.
+
+    Args:
+        path: path of the endpoint.
+        args: request query string parameters, their order doesn't matter.
+        versions: data versions of the tables the endpoint reads, a write to any of them changes the key.
+        encoding: Content-Encoding of the cached body, each encoding is cached separately.
+
+    Returns:
+        (str) hex digest identifying the response.
+    """
+
+    items = sorted(args.items(
+        multi=True)) if hasattr(args, "items") else sorted(args)
+    data = json.dumps([path, items, versions, encoding], separators=(',', ':'))
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+
+def make_etag(body):
+    return hashlib.sha256(body).hexdigest()[:32]
+
+
+class MemoryResponseCache:
+    """
+    Response cache kept in the memory of the process, evicting the least recently used entries once their bodies
+    add up to more than max_bytes.
+
+    Args:
+        max_bytes: maximum total size of the cached bodies.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Returns the (etag, body, headers) cached for key or None.
+        """
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def set(self, key, etag, body, headers):
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old[1])
+            self._entries[key] = (etag, body, headers)
+            self.size += len(body)
+            while self.size > self.max_bytes:
+                _, (_, evicted, _) = self._entries.popitem(last=False)
+                self.size -= len(evicted)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+
+class SQLiteResponseCache:
+    """
+    Response cache kept in a SQLite file, so every gunicorn worker on the machine shares the same entries. The
+    least recently used entries are evicted once their bodies add up to more than max_bytes.
+
+    A hit only reads the file: the access time of an entry is written at most once every touch_interval seconds, so
+    hits don't queue for the write lock, and the recency is only that precise. The total size of the bodies is kept
+    in a single row updated with each write, so stores don't sum the table.
+
+    Args:
+        path: path of the cache file, created if missing.
+        max_bytes: maximum total size of the cached bodies.
+        touch_interval: seconds after which a hit records its access time again.
+        timer: function returning the current time in seconds.
+    """
+
+    def __init__(self, path, max_bytes, touch_interval=60, timer=time.time):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.touch_interval = touch_interval
+        self.timer = timer
+        self._local = threading.local()
+        with self._connection() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS responses ("
+                         "key TEXT PRIMARY KEY, etag TEXT NOT NULL, "
+                         "body BLOB NOT NULL, headers TEXT NOT NULL, "
+                         "size INTEGER NOT NULL, accessed REAL NOT NULL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS ix_responses_accessed "
+                         "ON responses (accessed)")
+            conn.execute("CREATE TABLE IF NOT EXISTS responses_size ("
+                         "id INTEGER PRIMARY KEY CHECK (id = 0), "
+                         "total INTEGER NOT NULL)")
+            # counts the entries of a file written before the table existed
+            conn.execute("INSERT OR IGNORE INTO responses_size "
+                         "SELECT 0, COALESCE(SUM(size), 0) FROM responses")
+
+    def _connection(self):
+        # connections are per thread and per process, since gunicorn forks
+        # workers after the app is imported
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5)
+            conn.execute("PRAGMA journal_mode = WAL")
+            conn.execute("PRAGMA synchronous = NORMAL")
+            self._local.conn, self._local.pid = conn, os.getpid()
+        return conn
+
+    def get(self, key):
+        """
+        Returns the (etag, body, headers) cached for key or None.
+        """
+
+        conn = self._connection()
+        row = conn.execute(
+            "SELECT etag, body, headers, accessed FROM responses "
+            "WHERE key = ?", (key, )).fetchone()
+        if row is None:
+            return None
+        now = self.timer()
+        if now - row[3] >= self.touch_interval:
+            with conn:
+                conn.execute(
+                    "UPDATE responses SET accessed = ? "
+                    "WHERE key = ? AND accessed < ?", (now, key, now))
+        return row[0], row[1], json.loads(row[2])
+
+    def set(self, key, etag, body, headers):
+        conn = self._connection()
+        with conn:
+            # the size of a replaced entry must not change meanwhile
+            conn.execute("BEGIN IMMEDIATE")
+            old = conn.execute("SELECT size FROM responses WHERE key = ?",
+                               (key, )).fetchone()
+            conn.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)",
+                (key, etag, body, json.dumps(headers), len(body),
+                 self.timer()))
+            conn.execute("UPDATE responses_size SET total = total + ?",
+                         (len(body) - (old[0] if old else 0), ))
+            excess = conn.execute("SELECT total FROM responses_size").fetchone(
+            )[0] - self.max_bytes
+            if excess > 0:
+                self._evict(conn, excess)
+
+    def _evict(self, conn, excess):
+        # drop the oldest entries holding the excess, reading only those
+        evicted, freed = [], 0
+        for key, size in conn.execute(
+                "SELECT key, size FROM responses ORDER BY accessed"):
+            evicted.append((key, ))
+            freed += size
+            if freed >= excess:
+                break
+        conn.executemany("DELETE FROM responses WHERE key = ?", evicted)
+        conn.execute("UPDATE responses_size SET total = total - ?", (freed, ))
+
+    def clear(self):
+        conn = self._connection()
+        with conn:
+            conn.execute("DELETE FROM responses")
+            conn.execute("UPDATE responses_size SET total = 0")
+
+
+def create_response_cache(config):
+    """
+    Function used to create the response cache chosen by RESPONSE_CACHE_BACKEND.
+
+    Args:
+        config: app config.
+
+    Returns:
+        The cache, or None if the backend is 'none'.
+    """
+
+    backend = config['RESPONSE_CACHE_BACKEND']
+    if backend == "memory":
+        return MemoryResponseCache(config['RESPONSE_CACHE_MAX_BYTES'])
+    if backend == "sqlite":
+        return SQLiteResponseCache(config['RESPONSE_CACHE_PATH'],
+                                   config['RESPONSE_CACHE_MAX_BYTES'],
+                                   config['RESPONSE_CACHE_TOUCH_INTERVAL'])
+    if backend == "none":
+        return None
+    raise ValueError("RESPONSE_CACHE_BACKEND must be memory, sqlite or none")
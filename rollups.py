@@ -0,0 +1,258 @@
+from sqlalchemy import event, inspect, select, type_coerce
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.sql import ClauseElement
+
+from database import table_exists
+from models import Transaction, TransactionRollup
+from versions import bump_data_versions
+
+# strftime formats of the buckets of each period, the same as the day and
+# month groups of /transactions/summary.
+ROLLUP_PERIODS = {"day": "%Y-%m-%d", "month": "%Y-%m"}
+
+# Column of the transactions each dimension is totaled by.
+ROLLUP_DIMENSIONS = {"pharmacy": "pharmacy_uuid", "patient": "patient_uuid"}
+
+# Columns of the transactions the totals are computed from.
+ROLLUP_COLUMNS = ("patient_uuid", "pharmacy_uuid", "amount", "timestamp")
+
+
+def rollup_deltas(rows, sign=1, deltas=None):
+    """
+    Function used to add transactions to the totals they count in.
+
+    Args:
+        rows: mappings with the ROLLUP_COLUMNS of the transactions.
+        sign: 1 for transactions written, -1 for transactions removed.
+        deltas: totals to add to, a new dict by default.
+
+    Returns:
+        (dict) [count, amount] changes keyed by (period, dimension, bucket, uuid).
+    """
+
+    deltas = {} if deltas is None else deltas
+    for row in rows:
+        for period, fmt in ROLLUP_PERIODS.items():
+            bucket = row["timestamp"].strftime(fmt)
+            for dimension, column in ROLLUP_DIMENSIONS.items():
+                total = deltas.setdefault(
+                    (period, dimension, bucket, row[column]), [0, 0.0])
+                total[0] += sign
+                total[1] += sign * row["amount"]
+    return deltas
+
+
+def apply_rollup_deltas(conn, deltas):
+    """
+    Function used to add changes computed by rollup_deltas to the rollup table, with a single upsert.
+
+    Totals left without transactions are deleted. Nothing is done until flask upgrade-db has created the table.
+
+    Args:
+        conn: connection of the transaction writing the transactions.
+        deltas: changes returned by rollup_deltas.
+    """
+
+    values = [{
+        "period": period,
+        "dimension": dimension,
+        "bucket": bucket,
+        "uuid": uuid,
+        "count": count,
+        "amount": amount
+    } for (period, dimension, bucket, uuid), (count, amount) in deltas.items()
+              if count or amount]
+    if not values or not table_exists(conn.engine,
+                                      TransactionRollup.__tablename__):
+        return
+
+    table = TransactionRollup.__table__
+    dialect = postgresql if conn.dialect.name == "postgresql" else sqlite
+    insert = dialect.insert(table)
+    conn.execute(
+        insert.on_conflict_do_update(
+            index_elements=[column.name for column in table.primary_key],
+            set_={
+                "count": table.c["count"] + insert.excluded["count"],
+                "amount": table.c["amount"] + insert.excluded["amount"]
+            }), values)
+    if any(value["count"] < 0 for value in values):
+        conn.execute(table.delete().where(table.c["count"] <= 0))
+
+
+def rebuild_rollups(conn, statement, batch_size=1000):
+    """
+    Function used to recompute the rollup table from scratch, in the transaction of conn.
+
+    On postgres the transactions table is locked against writes meanwhile, sqlite only allows one writer anyway.
+
+    Args:
+        conn: database connection, in a transaction.
+        statement: select of the ROLLUP_COLUMNS of every transaction.
+        batch_size: rows read at a time.
+
+    Returns:
+        (int) number of totals written.
+    """
+
+    if conn.dialect.name == "postgresql":
+        # totals must not miss transactions written while they are computed
+        conn.exec_driver_sql("LOCK TABLE transactions IN SHARE MODE")
+    deltas = {}
+    result = conn.execution_options(stream_results=True).execute(statement)
+    for rows in result.mappings().partitions(batch_size):
+        rollup_deltas(rows, 1, deltas)
+    conn.execute(TransactionRollup.__table__.delete())
+    apply_rollup_deltas(conn, deltas)
+    bump_data_versions(conn, ["transactions"])
+    return len(deltas)
+
+
+def transaction_values(obj, committed=False):
+    """
+    Function used to read the ROLLUP_COLUMNS of a Transaction, as they are in the database if committed is True.
+    """
+
+    values = {}
+    for name in ROLLUP_COLUMNS:
+        history = inspect(obj).attrs[name].history
+        if committed and history.deleted:
+            values[name] = history.deleted[0]
+        else:
+            values[name] = getattr(obj, name)
+    return values
+
+
+def column_values(values):
+    # the keys of the values of a statement can be columns or their names
+    return {getattr(key, "key", key): value for key, value in values}
+
+
+def inserted_rows(conn, statement, parameters):
+    """
+    Function used to get the ROLLUP_COLUMNS of the transactions written by an INSERT, from its parameters and its
+    inline values. Values that are SQL expressions, bound parameters of .values(...) included, are evaluated by the
+    database.
+
+    Args:
+        conn: connection the INSERT runs on.
+        statement: the INSERT statement.
+        parameters: parameters passed with it, a dict or a list of dicts.
+
+    Returns:
+        (list) mappings of the ROLLUP_COLUMNS of each row.
+    """
+
+    if isinstance(parameters, dict):
+        parameters = [parameters]
+    if statement._multi_values:
+        rows = [
+            column_values(values.items())
+            for values in statement._multi_values[0]
+        ]
+    else:
+        inline = column_values((statement._values or {}).items())
+        rows = [dict(inline, **params)
+                for params in parameters] if parameters else [inline]
+
+    if not any(
+            isinstance(value, ClauseElement) for row in rows
+            for value in row.values()):
+        return rows
+    table = Transaction.__table__
+    return [
+        conn.execute(
+            select(*[
+                type_coerce(row[name], table.c[name].type).label(name)
+                for name in ROLLUP_COLUMNS
+            ])).mappings().first() for row in rows
+    ]
+
+
+def updated_values(statement, parameters):
+    """
+    Function used to get the SET clause of an UPDATE of transactions, from its .values(...) and its parameters.
+
+    Returns:
+        (dict) column names to the values or SQL expressions they are set to.
+    """
+
+    values = column_values(statement._ordered_values
+                           or (statement._values or {}).items())
+    if isinstance(parameters, dict):
+        values.update(parameters)
+    return values
+
+
+def track_rollups(session):
+    """
+    Function used to update the rollup table on every write of transactions made through session: ORM flushes as
+    well as bulk inserts, updates and deletes passed to session.execute. The totals change in the same database
+    transaction as the transactions. Writes made outside the session, through the engine or a Core connection,
+    aren't tracked and need flask rebuild-rollups.
+
+    Args:
+        session: session, sessionmaker or scoped_session to listen to.
+    """
+
+    @event.listens_for(session, "after_flush")
+    def after_flush(session, flush_context):
+        added = [obj for obj in session.new if isinstance(obj, Transaction)]
+        removed = [
+            obj for obj in session.deleted if isinstance(obj, Transaction)
+        ]
+        changed = [
+            obj for obj in session.dirty
+            if isinstance(obj, Transaction) and session.is_modified(obj)
+        ]
+        if not (added or removed or changed):
+            return
+        deltas = rollup_deltas(
+            [transaction_values(obj) for obj in added + changed])
+        rollup_deltas(
+            [transaction_values(obj, committed=True) for obj in changed] +
+            [transaction_values(obj) for obj in removed], -1, deltas)
+        apply_rollup_deltas(session.connection(), deltas)
+
+    @event.listens_for(session, "do_orm_execute")
+    def do_orm_execute(orm_execute_state):
+        statement = orm_execute_state.statement
+        table = getattr(statement, "table", None)
+        if table is None or table.name != Transaction.__tablename__:
+            return
+        conn = orm_execute_state.session.connection()
+
+        if orm_execute_state.is_insert:
+            apply_rollup_deltas(
+                conn,
+                rollup_deltas(
+                    inserted_rows(conn, statement,
+                                  orm_execute_state.parameters)))
+            return
+        if not (orm_execute_state.is_update or orm_execute_state.is_delete):
+            return
+
+        # the rows as they are and, for an update, as they will be: the SET
+        # expressions are evaluated on the rows before they change, so rows
+        # whose keys change are still found, and the totals can be changed
+        # ahead of the statement in the same database transaction
+        table = Transaction.__table__
+        columns = [table.c[name] for name in ROLLUP_COLUMNS]
+        if orm_execute_state.is_update:
+            values = updated_values(statement, orm_execute_state.parameters)
+            columns += [
+                type_coerce(values[name], table.c[name].type).label("new_" +
+                                                                    name)
+                if name in values else table.c[name].label("new_" + name)
+                for name in ROLLUP_COLUMNS
+            ]
+        query = select(*columns)
+        if statement.whereclause is not None:
+            query = query.where(statement.whereclause)
+        matched = conn.execute(query).mappings().all()
+        deltas = rollup_deltas(matched, -1)
+        if orm_execute_state.is_update:
+            rollup_deltas(
+                [{name: row["new_" + name]
+                  for name in ROLLUP_COLUMNS} for row in matched], 1, deltas)
+        apply_rollup_deltas(conn, deltas)
@@ -0,0 +1,173 @@
+from sqlalchemy import (and_, column, inspect, literal_column, or_, select,
+                        table, true)
+from sqlalchemy.exc import OperationalError
+
+from database import table_exists
+from models import Patient, Pharmacy, db
+
+# Columns of each table copied into its full-text index, the index is named
+# after the table with a '_fts' suffix.
+SEARCH_COLUMNS = {
+    "patients": ("first_name", "last_name"),
+    "pharmacies": ("name", "city"),
+}
+
+# The trigram tokenizer can only match terms with at least 3 characters.
+MIN_TERM_LENGTH = 3
+
+
+def search_index_ddl(table_name):
+    """
+    Function used to generate the statements creating the full-text index of a table and the triggers keeping it
+    in sync.
+
+    The index is a regular FTS5 table holding a copy of the columns and the uuid of the row. Entries are written
+    with the rowid of the row so the triggers can find them, but searches go back to the table by uuid, so rowids
+    changed by a VACUUM can at worst leave a stale entry behind, never return the wrong row.
+
+    Args:
+        table_name: name of a table in SEARCH_COLUMNS.
+
+    Returns:
+        (list) SQL statements.
+    """
+
+    fts = table_name + "_fts"
+    columns = ", ".join(SEARCH_COLUMNS[table_name])
+    new_values = ", ".join("new." + name
+                           for name in SEARCH_COLUMNS[table_name])
+    return [
+        f"CREATE VIRTUAL TABLE {fts} USING fts5(uuid UNINDEXED, {columns}, tokenize='trigram')",
+        f"CREATE TRIGGER {fts}_insert AFTER INSERT ON {table_name} BEGIN "
+        f"INSERT INTO {fts}(rowid, uuid, {columns}) VALUES (new.rowid, new.uuid, {new_values}); END",
+        f"CREATE TRIGGER {fts}_delete AFTER DELETE ON {table_name} BEGIN "
+        f"DELETE FROM {fts} WHERE rowid = old.rowid; END",
+        f"CREATE TRIGGER {fts}_update AFTER UPDATE ON {table_name} BEGIN "
+        f"DELETE FROM {fts} WHERE rowid = old.rowid; "
+        f"INSERT INTO {fts}(rowid, uuid, {columns}) VALUES (new.rowid, new.uuid, {new_values}); END",
+    ]
+
+
+def rebuild_search_index(conn, table_name):
+    """
+    Function used to fill the full-text index of a table from scratch.
+
+    Args:
+        conn: database connection.
+        table_name: name of a table in SEARCH_COLUMNS.
+    """
+
+    fts = table_name + "_fts"
+    columns = ", ".join(SEARCH_COLUMNS[table_name])
+    conn.exec_driver_sql(f"DELETE FROM {fts}")
+    conn.exec_driver_sql(
+        f"INSERT INTO {fts}(rowid, uuid, {columns}) SELECT rowid, uuid, {columns} FROM {table_name}"
+    )
+
+
+def create_search_indexes(conn):
+    """
+    Function used to create the missing full-text indexes, only sqlite builds with FTS5 support them.
+
+    Args:
+        conn: database connection.
+
+    Returns:
+        (list) names of the indexes created.
+    """
+
+    if conn.dialect.name != "sqlite":
+        return []
+
+    created = []
+    existing = inspect(conn).get_table_names()
+    for table_name in SEARCH_COLUMNS:
+        if table_name + "_fts" in existing:
+            continue
+        statements = search_index_ddl(table_name)
+        try:
+            conn.exec_driver_sql(statements[0])
+        except OperationalError:
+            # sqlite built without FTS5 or older than 3.34, searches fall back to LIKE
+            continue
+        for statement in statements[1:]:
+            conn.exec_driver_sql(statement)
+        rebuild_search_index(conn, table_name)
+        created.append(table_name + "_fts")
+    return created
+
+
+def search_index_available(table_name):
+    """
+    Function used to check if the full-text index of a table exists in the current database.
+    """
+
+    engine = db.engine
+    return engine.dialect.name == "sqlite" and table_exists(
+        engine, table_name + "_fts")
+
+
+def search_terms(q):
+    return [term for term in q.split() if term]
+
+
+def matching_uuids(model, term):
+    """
+    Function used to build the select of the uuids of the rows of model containing term in any searched column.
+    """
+
+    table_name = model.__tablename__
+    if len(term) >= MIN_TERM_LENGTH and search_index_available(table_name):
+        fts = table(table_name + "_fts", column("uuid"))
+        phrase = '"' + term.replace('"', '""') + '"'
+        return select(fts.c.uuid).where(
+            literal_column(fts.name).op("MATCH")(phrase))
+
+    columns = [getattr(model, name) for name in SEARCH_COLUMNS[table_name]]
+    return select(model.uuid).where(
+        or_(*[column.like(f'%{term}%') for column in columns]))
+
+
+def search_filter(model, q):
+    """
+    Function used to build the filter of the 'q' parameter of /patients and /pharmacies.
+
+    Every whitespace separated term of q must appear, ignoring case, in some searched column of the row. Terms are
+    looked up in the full-text index when it exists, terms too short for it and databases without it use LIKE.
+
+    Args:
+        model: Patient or Pharmacy.
+        q: search text.
+
+    Returns:
+        SQL expression of the filter.
+    """
+
+    return and_(
+        true(), *[
+            model.uuid.in_(matching_uuids(model, term))
+            for term in search_terms(q)
+        ])
+
+
+def transaction_search_filter(transaction, q):
+    """
+    Function used to build the filter of the 'q' parameter of /transactions.
+
+    Every whitespace separated term of q must appear in the searched columns of the transaction's patient or
+    pharmacy.
+
+    Args:
+        transaction: entity the transactions are selected from, see partitions.transaction_source.
+        q: search text.
+
+    Returns:
+        SQL expression of the filter.
+    """
+
+    return and_(
+        true(), *[
+            or_(transaction.patient_uuid.in_(matching_uuids(Patient, term)),
+                transaction.pharmacy_uuid.in_(matching_uuids(Pharmacy, term)))
+            for term in search_terms(q)
+        ])
@@ -0,0 +1,171 @@
+import json
+
+try:
+    import orjson
+except ImportError:  # optional, the standard library encoder is used instead
+    orjson = None
+
+NDJSON_MIMETYPE = 'application/x-ndjson'
+
+# Serializers of rows with all the fields of queries.patient_fields,
+# pharmacy_fields and transaction_fields, faster than the ones built by
+# fields_serializer for the same output.
+
+
+def patient_to_dict(row):
+    return {
+        "date_of_birth": row[3],
+        "first_name": row[1],
+        "id": row[0],
+        "last_name": row[2],
+    }
+
+
+def pharmacy_to_dict(row):
+    return {
+        "city": row[2],
+        "id": row[0],
+        "name": row[1],
+    }
+
+
+def transaction_to_dict(row):
+    return {
+        "amount": row[1],
+        "id": row[0],
+        "patient": patient_to_dict(row[3:7]),
+        "pharmacy": pharmacy_to_dict(row[7:10]),
+        "timestamp": row[2],
+    }
+
+
+def fields_serializer(fields):
+    """
+    Function used to build the function turning a row selecting the columns of fields into a dict.
+
+    Keys are written in alphabetical order, the order jsonify sorted them in, so the bodies don't need to be sorted
+    when encoded.
+
+    Args:
+        fields: selected fields, see queries.select_fields. Rows have their columns in the same order, followed by
+            any number of columns that aren't sent.
+
+    Returns:
+        Function turning a row tuple into a dict.
+    """
+
+    # (name, index of the column, None) or (name, None, [(name, index)]) of nested objects
+    layout = []
+    index = 0
+    for name, value in fields.items():
+        if isinstance(value, dict):
+            nested = sorted(zip(value, range(index, index + len(value))))
+            layout.append((name, None, nested))
+            index += len(value)
+        else:
+            layout.append((name, index, None))
+            index += 1
+    layout.sort(key=lambda item: item[0])
+
+    def serialize(row):
+        return {
+            name: row[index]
+            if nested is None else {field: row[i]
+                                    for field, i in nested}
+            for name, index, nested in layout
+        }
+
+    return serialize
+
+
+def std_dumps(value):
+    return json.dumps(value, separators=(',', ':')).encode('utf-8')
+
+
+def json_encoder(name):
+    """
+    Function used to choose the encoder of the list endpoint bodies.
+
+    Args:
+        name: 'orjson', 'json' for the standard library or 'auto' for orjson when it is installed.
+
+    Returns:
+        Function turning a value into json bytes.
+    """
+
+    if name == "auto":
+        name = "json" if orjson is None else "orjson"
+    if name == "orjson":
+        if orjson is None:
+            raise ValueError("JSON_ENCODER orjson needs the orjson package")
+        return orjson.dumps
+    if name == "json":
+        return std_dumps
+    raise ValueError("JSON_ENCODER must be auto, orjson or json")
+
+
+def stream_format(request):
+    """
+    Function used to check if a request asked for a streamed response.
+
+    Args:
+        request: request being handled.
+
+    Returns:
+        (str) 'ndjson' if the Accept header has application/x-ndjson, 'json' if the 'stream' parameter is set,
+        None if the response shouldn't be streamed.
+    """
+
+    if NDJSON_MIMETYPE in request.accept_mimetypes.values():
+        return "ndjson"
+    if request.args.get("stream", "").lower() in ("1", "true"):
+        return "json"
+    return None
+
+
+def encode_batch(batch, fmt, written):
+    """
+    Function used to join a batch of json encoded rows into a chunk of a streamed body, see stream_rows.
+
+    Args:
+        batch: list of json bytes.
+        fmt: 'json' or 'ndjson'.
+        written: number of rows already written.
+    """
+
+    if fmt == "ndjson":
+        return b"\n".join(batch) + b"\n"
+    return (b"," if written else b"") + b",".join(batch)
+
+
+def stream_rows(rows, serialize, dumps, fmt, batch_size):
+    """
+    Generator used to write rows as they are read instead of building the whole response in memory.
+
+    Args:
+        rows: iterable of rows, usually a query with yield_per.
+        serialize: function turning a row into a dict.
+        dumps: function turning a dict into json bytes, see json_encoder.
+        fmt: 'json' to write a json array or 'ndjson' to write one json object per line.
+        batch_size: number of rows written per chunk.
+
+    Yields:
+        (bytes) chunks of the response body.
+    """
+
+    if fmt == "json":
+        yield b"["
+
+    written = 0
+    batch = []
+    for row in rows:
+        batch.append(dumps(serialize(row)))
+        if len(batch) == batch_size:
+            yield encode_batch(batch, fmt, written)
+            written += len(batch)
+            batch = []
+    if batch:
+        yield encode_batch(batch, fmt, written)
+
+    if fmt == "json":
+        yield b"]"
@@ -0,0 +1,131 @@
+import random
+
+from sqlalchemy import event, select
+
+from database import table_exists
+from models import DataVersion, db
+
+# Tables whose writes are counted in data_versions.
+VERSIONED_TABLES = ("users", "patients", "pharmacies", "transactions")
+
+# Row holding a random number picked when data_versions is created. A database
+# restored from a backup or replaced by another file has a different epoch,
+# so its versions never match the ones cached for the old database.
+EPOCH = "_epoch"
+
+
+def versions_enabled(engine):
+    return table_exists(engine, DataVersion.__tablename__)
+
+
+def seed_data_versions(conn):
+    """
+    Function used to add the missing rows of data_versions, starting at version 0.
+    """
+
+    table = DataVersion.__table__
+    existing = {
+        table_name
+        for table_name, in conn.execute(table.select().with_only_columns(
+            table.c.table_name))
+    }
+    missing = [{
+        "table_name": table_name,
+        "version": 0
+    } for table_name in VERSIONED_TABLES if table_name not in existing]
+    if EPOCH not in existing:
+        missing.append({
+            "table_name": EPOCH,
+            "version": random.randint(1, 2**31 - 1)
+        })
+    if missing:
+        conn.execute(table.insert(), missing)
+
+
+def bump_data_versions(conn, table_names):
+    """
+    Function used to increment the version of tables written in the current transaction, so the change is
+    committed or rolled back together with the write.
+
+    Args:
+        conn: connection of the transaction writing to the tables.
+        table_names: names of the tables written.
+    """
+
+    table_names = sorted(set(table_names).intersection(VERSIONED_TABLES))
+    if not table_names or not versions_enabled(conn.engine):
+        return
+
+    table = DataVersion.__table__
+    conn.execute(table.update().where(
+        table.c.table_name.in_(table_names)).values(version=table.c.version +
+                                                    1))
+
+
+def data_versions(table_names, session=None):
+    """
+    Function used to read the current version of tables.
+
+    Args:
+        table_names: names of the tables.
+        session: session reading them, db.session by default.
+
+    Returns:
+        (tuple) epoch of the database followed by the versions in the same order as table_names, or None if the
+        database has no data_versions table.
+    """
+
+    session = session or db.session
+    if not versions_enabled(session.bind):
+        return None
+
+    statement = data_versions_statement(table_names)
+    return versions_of(table_names, session.execute(statement))
+
+
+def data_versions_statement(table_names):
+    """
+    Function used to build the select of the rows data_versions reads.
+    """
+
+    return select(DataVersion.table_name, DataVersion.version).where(
+        DataVersion.table_name.in_((EPOCH, ) + tuple(table_names)))
+
+
+def versions_of(table_names, rows):
+    """
+    Function used to turn the rows selected by data_versions_statement into the tuple returned by data_versions.
+    """
+
+    versions = dict(rows.all())
+    return tuple(
+        versions.get(name, 0) for name in (EPOCH, ) + tuple(table_names))
+
+
+def track_data_versions(session):
+    """
+    Function used to bump data_versions on every write made through session: ORM flushes as well as bulk
+    inserts, updates and deletes passed to session.execute.
+
+    Args:
+        session: session, sessionmaker or scoped_session to listen to.
+    """
+
+    @event.listens_for(session, "after_flush")
+    def after_flush(session, flush_context):
+        objects = list(session.new) + list(session.dirty) + list(
+            session.deleted)
+        bump_data_versions(session.connection(), {
+            obj.__table__.name
+            for obj in objects if hasattr(obj, "__table__")
+        })
+
+    @event.listens_for(session, "do_orm_execute")
+    def do_orm_execute(orm_execute_state):
+        if not (orm_execute_state.is_insert or orm_execute_state.is_update
+                or orm_execute_state.is_delete):
+            return
+        table = getattr(orm_execute_state.statement, "table", None)
+        if table is not None:
+            bump_data_versions(orm_execute_state.session.connection(),
+                               [table.name])